@@ -1,58 +1,143 @@
 # app.py
 
+import time
+_startup_t0 = time.perf_counter() # Taken before the heavy imports so they show up in the startup report
+
 import sys
 import os
+import signal
+import mimetypes
 import threading
-import queue
 import asyncio
 import websockets
-import time
+import bus
 import control
+import tracing
+import metrics
 
 # --- PyQt5 Imports ---
 from PyQt5.QtWidgets import QApplication, QMainWindow
 from PyQt5 import QtWebEngineWidgets, QtGui, QtCore
-from PyQt5.QtCore import QUrl, QObject, pyqtSlot, Qt
-from PyQt5.QtNetwork import QUdpSocket, QHostAddress
-
-# --- Web Server Imports ---
-import http.server
-import socketserver
+from PyQt5.QtCore import QUrl, QObject, pyqtSlot, pyqtSignal, Qt
+from PyQt5.QtWebEngineCore import QWebEngineUrlScheme, QWebEngineUrlSchemeHandler, QWebEngineUrlRequestJob
 
 # --- Configuration ---
-HTTP_PORT = 8000
+UI_SCHEME = 'ketta-ui' # Custom URL scheme the UI assets are served from, straight from memory
+UI_ENTRY_PAGE = 'html_files/app.html' # Relative to the html_files directory
+PREWARM_RENDER_MS = 500 # How long the page renders off-screen before the window is hidden again
 WEBSOCKET_PORT = 8765
-COMMAND_UDP_PORT = 45454
-LOUDNESS_UDP_PORT = 45455
-
-loudness_queue = queue.Queue()
+LOUDNESS_FRAME_INTERVAL = 1 / 30 # The orb is redrawn at most this often
+CLIENT_BUFFER_FRAMES = 2 # Frames a slow client may fall behind before old ones are dropped
 
 # --- 1. WebSocket Server ---
-clients = set()
-async def loudness_broadcaster(q):
+# Everything below runs on the websocket thread's event loop, except receive_loudness.
+latest_loudness = None # Newest loudness value not yet broadcast
+clients = {} # websocket -> asyncio.Queue of frames waiting to be sent to it
+
+metrics.gauge('ketta_ui_clients', "Connected websocket clients", fn=lambda: len(clients))
+metrics.gauge('ketta_ui_buffered_frames', "Loudness frames queued for clients but not yet sent",
+              fn=lambda: sum(buffer.qsize() for buffer in list(clients.values())))
+frame_counter = metrics.counter('ketta_ui_loudness_frames_total', "Loudness frames broadcast")
+dropped_frame_counter = metrics.counter('ketta_ui_dropped_frames_total', "Loudness frames dropped for slow clients")
+
+def receive_loudness(loudness, message):
+    """Bus callback: keeps only the newest value. A plain assignment, so no hop onto the event loop."""
+    global latest_loudness
+    latest_loudness = loudness
+
+async def loudness_broadcaster():
+    """Hands the newest loudness value to every client once per frame."""
+    global latest_loudness
+    loop = asyncio.get_running_loop()
+    next_frame = loop.time()
     while True:
-        try:
-            loudness = await asyncio.to_thread(q.get)
-            if clients:
-                await asyncio.gather(*[client.send(str(loudness)) for client in clients])
-        except Exception:
-            await asyncio.sleep(1)
+        next_frame += LOUDNESS_FRAME_INTERVAL
+        delay = next_frame - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        else:
+            next_frame = loop.time() # We fell behind; don't try to catch up with a burst
+        if latest_loudness is None:
+            continue
+        frame = str(latest_loudness)
+        latest_loudness = None
+        frame_counter.inc()
+        for buffer in clients.values():
+            if buffer.full():
+                buffer.get_nowait() # Slow client: drop its oldest frame instead of waiting
+                dropped_frame_counter.inc()
+            buffer.put_nowait(frame)
+
+async def client_sender(websocket, buffer):
+    try:
+        while True:
+            await websocket.send(await buffer.get())
+    except websockets.exceptions.ConnectionClosed:
+        pass
 
 async def handler(websocket, path):
-    clients.add(websocket)
+    buffer = asyncio.Queue(maxsize=CLIENT_BUFFER_FRAMES)
+    clients[websocket] = buffer
+    sender = asyncio.ensure_future(client_sender(websocket, buffer))
     try:
         await websocket.wait_closed()
     finally:
-        clients.remove(websocket)
+        del clients[websocket]
+        sender.cancel()
 
-def run_websocket_server(q):
+def run_websocket_server():
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
-    start_server = websockets.serve(handler, "localhost", WEBSOCKET_PORT)
-    loop.run_until_complete(asyncio.gather(start_server, loudness_broadcaster(q)))
+    loop.run_until_complete(websockets.serve(handler, "localhost", WEBSOCKET_PORT))
+    bus.subscribe(bus.TOPIC_UI_LOUDNESS, receive_loudness)
+    print(f"Listening for loudness on '{bus.TOPIC_UI_LOUDNESS}'")
+    loop.create_task(loudness_broadcaster())
     loop.run_forever()
 
-# --- 2. Custom WebEnginePage to Intercept Clicks ---
+# --- 2. In-Memory UI Assets ---
+startup = metrics.StartupProfile(_startup_t0)
+
+def load_ui_assets(html_dir):
+    """Reads every file under html_dir into memory, keyed by its URL path."""
+    assets = {}
+    for root, _, filenames in os.walk(html_dir):
+        for filename in filenames:
+            filepath = os.path.join(root, filename)
+            url_path = os.path.relpath(filepath, html_dir).replace(os.sep, '/')
+            mime_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+            try:
+                with open(filepath, 'rb') as f:
+                    assets[url_path] = (mime_type.encode('ascii'), f.read())
+            except OSError as e:
+                print(f"Could not load UI asset '{filepath}': {e}")
+    return assets
+
+def register_ui_scheme():
+    """Declares the asset scheme to Qt WebEngine. Must run before QApplication is created."""
+    scheme = QWebEngineUrlScheme(UI_SCHEME.encode('ascii'))
+    scheme.setSyntax(QWebEngineUrlScheme.Syntax.Host)
+    scheme.setFlags(QWebEngineUrlScheme.SecureScheme | QWebEngineUrlScheme.LocalAccessAllowed |
+                    QWebEngineUrlScheme.CorsEnabled)
+    QWebEngineUrlScheme.registerScheme(scheme)
+
+class AssetSchemeHandler(QWebEngineUrlSchemeHandler):
+    """Answers UI_SCHEME requests from the preloaded assets, without touching the disk."""
+    def __init__(self, assets, parent=None):
+        super().__init__(parent)
+        self.assets = assets
+
+    def requestStarted(self, job):
+        asset = self.assets.get(job.requestUrl().path().lstrip('/'))
+        if asset is None:
+            job.fail(QWebEngineUrlRequestJob.UrlNotFound)
+            return
+        mime_type, data = asset
+        buffer = QtCore.QBuffer(parent=job) # Freed together with the job
+        buffer.setData(data)
+        buffer.open(QtCore.QIODevice.ReadOnly)
+        job.reply(mime_type, buffer)
+
+# --- 3. Custom WebEnginePage to Intercept Clicks ---
 class ClickableWebEnginePage(QtWebEngineWidgets.QWebEnginePage):
     def __init__(self, window, parent=None):
         super().__init__(parent)
@@ -81,12 +166,16 @@ class ClickableWebEnginePage(QtWebEngineWidgets.QWebEnginePage):
         return super().acceptNavigationRequest(url, _type, isMainFrame)
 
 
-# --- 3. PyQt Main Application ---
+# --- 4. PyQt Main Application ---
 class MainWindow(QMainWindow):
-    def __init__(self, loudness_q):
+    # Bus callbacks run on the bus reader thread; the signal carries commands onto the Qt thread.
+    command_received = pyqtSignal(str, str)
+
+    def __init__(self, assets):
         super().__init__()
-        self.loudness_q = loudness_q
-        
+        self.prewarming = False
+        self.startup_reported = False
+
         self.setWindowIcon(QtGui.QIcon('logo.png'))
         self.setWindowTitle('Ketta')
         self.setWindowFlags(Qt.FramelessWindowHint | Qt.WindowStaysOnTopHint | Qt.Tool)
@@ -100,85 +189,116 @@ class MainWindow(QMainWindow):
 
         self.page.setBackgroundColor(Qt.transparent)
 
-        # -- Setup Local Web Server --
-        base_dir = os.path.dirname(os.path.abspath(__file__))
-        html_dir = os.path.join(base_dir, 'html_files')
-        os.makedirs(html_dir, exist_ok=True)
-        
-        os.chdir(html_dir)
-        self.http_server = http.server.HTTPServer(("", HTTP_PORT), http.server.SimpleHTTPRequestHandler)
-        self.http_thread = threading.Thread(target=self.http_server.serve_forever, daemon=True)
-        self.http_thread.start()
-        
-        self.view.load(QUrl(f"http://localhost:{HTTP_PORT}/html_files/app.html"))
+        # -- Serve the UI from memory --
+        self.scheme_handler = AssetSchemeHandler(assets, self)
+        self.page.profile().installUrlSchemeHandler(UI_SCHEME.encode('ascii'), self.scheme_handler)
+        self.page.loadFinished.connect(self.on_load_finished)
+        self.view.load(QUrl(f"{UI_SCHEME}://ui/{UI_ENTRY_PAGE}"))
         self.setCentralWidget(self.view)
-        
-        os.chdir(base_dir)
 
-        # -- Setup UDP Sockets --
-        self.command_socket = QUdpSocket(self)
-        self.command_socket.bind(QHostAddress.LocalHost, COMMAND_UDP_PORT)
-        self.command_socket.readyRead.connect(self.process_command_datagrams)
-        print(f"Listening for UI commands on UDP port {COMMAND_UDP_PORT}")
+        # -- Subscribe to UI commands --
+        self.command_received.connect(self.process_command)
+        bus.subscribe(bus.TOPIC_UI_COMMAND,
+                      lambda command, message: self.command_received.emit(command, message.get('turn') or ''))
+        print(f"Listening for UI commands on '{bus.TOPIC_UI_COMMAND}'")
+
+    def on_load_finished(self, ok):
+        startup.record('page load' if ok else 'page load (failed)')
+        if ok and not self.isVisible():
+            self.prewarm()
+        else:
+            self.report_startup() # Nothing left to warm up: a 'show' already made the window real
 
-        self.loudness_socket = QUdpSocket(self)
-        self.loudness_socket.bind(QHostAddress.LocalHost, LOUDNESS_UDP_PORT)
-        self.loudness_socket.readyRead.connect(self.process_loudness_datagrams)
-        print(f"Listening for loudness on UDP port {LOUDNESS_UDP_PORT}")
+    def prewarm(self):
+        """Creates the native window and renders the page off-screen, so the first 'show' is instant."""
+        self.prewarming = True
+        self.setAttribute(Qt.WA_DontShowOnScreen, True)
+        self.show()
+        QtCore.QTimer.singleShot(PREWARM_RENDER_MS, self.finish_prewarm)
+
+    def finish_prewarm(self):
+        if not self.prewarming:
+            return # A real 'show' already took over
+        self.end_prewarm()
+
+    def end_prewarm(self, interrupted=False):
+        """Ends the pre-warm, when its render is done or a real 'show' interrupts it."""
+        self.prewarming = False
+        self.hide()
+        self.setAttribute(Qt.WA_DontShowOnScreen, False)
+        startup.record('pre-warm (interrupted)' if interrupted else 'pre-warm')
+        self.report_startup()
+
+    def report_startup(self):
+        """Prints the startup phases once, from whichever path finishes startup."""
+        if self.startup_reported:
+            return
+        self.startup_reported = True
+        startup.report()
 
     def keyPressEvent(self, event):
         """Closes the application when the Escape key is pressed."""
         if event.key() == Qt.Key_Escape:
             self.close()
 
-    def process_command_datagrams(self):
-        """Processes incoming UDP commands for the UI."""
-        while self.command_socket.hasPendingDatagrams():
-            datagram = self.command_socket.receiveDatagram()
-            command = bytes(datagram.data()).decode('utf-8').strip()
-            print(f"Received UI command: '{command}'")
-            if command == 'show':
-                self.show()
-                self.raise_()
-                self.activateWindow()
-            elif command == 'hide':
-                self.hide()
-            else:
-                self.page.runJavaScript(f"setMode('{command}');")
-
-    def process_loudness_datagrams(self):
-        """Receives loudness data and puts it in the queue for the WebSocket server."""
-        while self.loudness_socket.hasPendingDatagrams():
-            datagram = self.loudness_socket.receiveDatagram()
-            try:
-                loudness_str = bytes(datagram.data()).decode('utf-8').strip()
-                self.loudness_q.put(float(loudness_str))
-            except (ValueError, UnicodeDecodeError):
-                pass # Ignore malformed data
+    def process_command(self, command, turn=''):
+        """Processes incoming commands for the UI."""
+        command = command.strip()
+        print(f"Received UI command: '{command}'")
+        tracing.mark(turn, 'ui', command)
+        if command == 'show':
+            if self.prewarming:
+                self.end_prewarm(interrupted=True)
+            self.show()
+            self.raise_()
+            self.activateWindow()
+        elif command == 'hide':
+            self.hide()
+        else:
+            self.page.runJavaScript(f"setMode('{command}');")
 
     def closeEvent(self, event):
         """Ensures servers are shut down when the window closes."""
         print("Shutting down servers and closing application...")
-        control.send_tts_command('stop_audio')
-        time.sleep(0.1) # Give the command a moment to be processed
-        self.http_server.shutdown()
+        control.send_tts_command('stop_audio', ack=True) # Wait until the broker has it
         super().closeEvent(event)
 
 # --- Main Execution ---
-if __name__ == '__main__':
-    websocket_thread = threading.Thread(target=run_websocket_server, args=(loudness_queue,), daemon=True)
+def run_ui(argv=None):
+    """Starts the orb and runs the Qt event loop on the calling thread, which must be the main thread."""
+    bus.ensure_broker()
+    metrics.start()
+    websocket_thread = threading.Thread(target=run_websocket_server, daemon=True)
     websocket_thread.start()
 
-    app = QApplication(sys.argv)
+    html_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'html_files')
+    os.makedirs(html_dir, exist_ok=True)
+    startup.record('imports')
+    ui_assets = load_ui_assets(html_dir)
+    startup.record(f'asset preload ({len(ui_assets)} files)')
+
+    register_ui_scheme()
+    app = QApplication(sys.argv if argv is None else argv)
     app.setApplicationName('Ketta')
+    # Qt's event loop only hands control back to Python on UI events, so Ctrl+C would go
+    # unnoticed until the next one; an idle timer lets the signal handler run promptly.
+    signal.signal(signal.SIGINT, lambda *_: app.quit())
+    signal_timer = QtCore.QTimer()
+    signal_timer.timeout.connect(lambda: None)
+    signal_timer.start(200)
+    startup.record('QApplication')
 
     screen = app.primaryScreen().geometry()
     base_dim = min(screen.width(), screen.height())
     win_size = int(base_dim * 0.25)
     
-    window = MainWindow(loudness_queue)
+    window = MainWindow(ui_assets)
     window.setGeometry((screen.width() - win_size) // 2, (screen.height() - win_size) // 2, win_size, win_size)
+    startup.record('window')
     
     print("Orb application is running in the background. Send a 'show' command to make it visible.")
     
-    sys.exit(app.exec_())
+    return app.exec_()
+
+if __name__ == '__main__':
+    sys.exit(run_ui())
@@ -0,0 +1,238 @@
+# app_launcher.py
+
+import os
+import time
+import shutil
+import threading
+import subprocess
+import metrics
+
+# --- Configuration ---
+LAUNCH_GRACE_PERIOD = 5.0  # A non-zero exit within this many seconds counts as a failed launch
+WINDOW_TIMEOUT = 15.0      # How long to look for the app's first window (needs wmctrl)
+WINDOW_POLL_INTERVAL = 0.1
+TERMINAL_COMMAND = ['x-terminal-emulator', '-e']
+LIFETIME_BUCKETS = (1, 5, 15, 60, 300, 900, 3600) # Seconds; apps live far longer than the default timer buckets
+
+# Field codes that expand to files/URLs; we never pass any, so they are dropped.
+_FILE_FIELD_CODES = {'%f', '%F', '%u', '%U'}
+_DEPRECATED_FIELD_CODES = {'%d', '%D', '%n', '%N', '%v', '%m'}
+
+def _unescape_string(value):
+    """Undoes the desktop entry string escapes (\\s, \\n, \\t, \\r, \\\\)."""
+    out = []
+    chars = iter(value)
+    for char in chars:
+        if char == '\\':
+            escaped = next(chars, '')
+            out.append({'s': ' ', 'n': '\n', 't': '\t', 'r': '\r', '\\': '\\'}.get(escaped, '\\' + escaped))
+        else:
+            out.append(char)
+    return ''.join(out)
+
+def _split_exec(exec_value):
+    """Splits an Exec value into arguments, honouring the spec's double-quote rules."""
+    args = []
+    current = []
+    in_quotes = False
+    has_arg = False
+    chars = iter(exec_value)
+    for char in chars:
+        if in_quotes:
+            if char == '\\':
+                current.append(next(chars, ''))
+            elif char == '"':
+                in_quotes = False
+            else:
+                current.append(char)
+        elif char == '"':
+            in_quotes = True
+            has_arg = True
+        elif char.isspace():
+            if has_arg:
+                args.append(''.join(current))
+                current = []
+                has_arg = False
+        else:
+            current.append(char)
+            has_arg = True
+    if in_quotes:
+        raise ValueError(f"Unterminated quote in Exec value: {exec_value!r}")
+    if has_arg:
+        args.append(''.join(current))
+    return args
+
+def parse_exec(exec_value, name='', icon='', desktop_file=''):
+    """
+    Turns a .desktop Exec value into an argv list, following the Desktop Entry
+    specification: string escapes, quoting, and field codes (%i, %c, %k and %%
+    are expanded; file and URL codes are removed because we launch without any).
+    Raises ValueError for a malformed value.
+    """
+    argv = []
+    for arg in _split_exec(_unescape_string(exec_value)):
+        if arg in _FILE_FIELD_CODES or arg in _DEPRECATED_FIELD_CODES:
+            continue
+        if arg == '%i':
+            if icon:
+                argv.extend(['--icon', icon])
+            continue
+        expanded = []
+        i = 0
+        while i < len(arg):
+            if arg[i] == '%' and i + 1 < len(arg):
+                code = arg[i:i + 2]
+                if code == '%%':
+                    expanded.append('%')
+                elif code == '%c':
+                    expanded.append(name)
+                elif code == '%k':
+                    expanded.append(desktop_file)
+                # Any other field code inside an argument expands to nothing.
+                i += 2
+            else:
+                expanded.append(arg[i])
+                i += 1
+        argv.append(''.join(expanded))
+    if not argv or not argv[0]:
+        raise ValueError(f"Empty Exec value: {exec_value!r}")
+    return argv
+
+def _descendant_pids(pid):
+    """Returns pid and all of its descendants, read from /proc."""
+    pids = {pid}
+    pending = [pid]
+    while pending:
+        parent = pending.pop()
+        try:
+            tids = os.listdir(f'/proc/{parent}/task')
+        except OSError:
+            continue
+        for tid in tids:
+            try:
+                with open(f'/proc/{parent}/task/{tid}/children', 'r') as f:
+                    children = [int(child) for child in f.read().split()]
+            except (OSError, ValueError):
+                continue
+            for child in children:
+                if child not in pids:
+                    pids.add(child)
+                    pending.append(child)
+    return pids
+
+def _window_pids():
+    """Returns the pids owning a top-level window, or None if wmctrl is unavailable."""
+    try:
+        output = subprocess.run(['wmctrl', '-lp'], capture_output=True, text=True, timeout=2).stdout
+    except (OSError, subprocess.SubprocessError):
+        return None
+    pids = set()
+    for line in output.splitlines():
+        fields = line.split(None, 3)
+        if len(fields) >= 3 and fields[2].isdigit():
+            pids.add(int(fields[2]))
+    return pids
+
+class LaunchRecord:
+    """What happened to one launch, filled in by its monitor thread."""
+    def __init__(self, name, argv):
+        self.name = name
+        self.argv = argv
+        self.pid = None
+        self.status = 'starting' # starting -> running -> exited | failed
+        self.exit_code = None
+        self.started_at = time.monotonic()
+        self.spawn_latency = None
+        self.time_to_window = None
+        self.time_to_exit = None
+        self.error = None
+
+    def as_dict(self):
+        return dict(vars(self))
+
+class AppLauncher:
+    """
+    Spawns applications detached from the assistant and keeps a monitor thread
+    per child, so every child is reaped and its outcome is recorded: the time
+    to its first window (when wmctrl is installed), or the time to its exit
+    status. Exiting with an error within LAUNCH_GRACE_PERIOD is a failed launch.
+    Counts and latencies are exported through the metrics registry.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.active = {} # pid -> (Popen, LaunchRecord)
+        self.track_windows = shutil.which('wmctrl') is not None
+        self.launch_counter = metrics.counter('ketta_app_launches_total', "Applications started")
+        self.failure_counter = metrics.counter('ketta_app_launch_failures_total',
+                                               "Launches that could not start or exited with an error right away")
+        self.spawn_timer = metrics.timer('ketta_app_spawn_seconds', "Time to spawn an application's process")
+        self.window_timer = metrics.timer('ketta_app_time_to_window_seconds',
+                                          "Time from launch to the application's first window (needs wmctrl)")
+        self.lifetime_timer = metrics.timer('ketta_app_lifetime_seconds', "Time from launch to the application's exit",
+                                            buckets=LIFETIME_BUCKETS)
+        metrics.gauge('ketta_app_running', "Launched applications that have not exited", fn=lambda: len(self.active))
+
+    def launch(self, app_info):
+        """Starts an application from its index entry. Returns its LaunchRecord."""
+        try:
+            argv = parse_exec(app_info['exec'], app_info['name'], app_info.get('icon', ''),
+                              app_info.get('desktop_file', ''))
+            argv[0] = app_info['exec_path']
+        except (KeyError, ValueError) as e:
+            # Entries without a parsable Exec still launch the way they always did.
+            print(f"Cannot parse Exec for '{app_info['name']}' ({e}); launching without arguments.")
+            argv = [app_info['exec_path']]
+        if app_info.get('terminal'):
+            argv = TERMINAL_COMMAND + argv
+
+        record = LaunchRecord(app_info['name'], argv)
+        working_dir = app_info.get('working_dir') or None
+        try:
+            process = subprocess.Popen(argv, cwd=working_dir, stdin=subprocess.DEVNULL,
+                                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                                       start_new_session=True)
+        except OSError as e:
+            record.status = 'failed'
+            record.error = str(e)
+            self.failure_counter.inc()
+            raise
+
+        record.pid = process.pid
+        record.spawn_latency = time.monotonic() - record.started_at
+        self.launch_counter.inc()
+        self.spawn_timer.observe(record.spawn_latency)
+        with self.lock:
+            self.active[process.pid] = (process, record)
+        threading.Thread(target=self._monitor, args=(process, record), daemon=True).start()
+        return record
+
+    def _monitor(self, process, record):
+        if self.track_windows:
+            deadline = record.started_at + WINDOW_TIMEOUT
+            while time.monotonic() < deadline and process.poll() is None:
+                window_pids = _window_pids()
+                if window_pids is None:
+                    break
+                if window_pids & _descendant_pids(process.pid):
+                    record.time_to_window = time.monotonic() - record.started_at
+                    record.status = 'running'
+                    self.window_timer.observe(record.time_to_window)
+                    print(f"'{record.name}' showed a window after {record.time_to_window * 1000:.0f} ms")
+                    break
+                time.sleep(WINDOW_POLL_INTERVAL)
+        if record.status == 'starting' and process.poll() is None:
+            record.status = 'running'
+
+        # Blocks until the child exits; this is what reaps it.
+        record.exit_code = process.wait()
+        record.time_to_exit = time.monotonic() - record.started_at
+        self.lifetime_timer.observe(record.time_to_exit)
+        if record.exit_code != 0 and record.time_to_exit < LAUNCH_GRACE_PERIOD:
+            record.status = 'failed'
+            record.error = f"exited with status {record.exit_code}"
+            self.failure_counter.inc()
+            print(f"Launch of '{record.name}' failed: {record.error} after {record.time_to_exit:.2f} s")
+        else:
+            record.status = 'exited'
+        with self.lock:
+            self.active.pop(process.pid, None)
@@ -0,0 +1,155 @@
+# app_matcher.py
+
+import os
+import re
+import json
+import math
+import threading
+
+# --- Configuration ---
+USAGE_FILE_PATH = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+                               'ketta', 'app_usage.json')
+MATCH_CUTOFF = 0.55  # Minimum score for a candidate to be launched
+USAGE_WEIGHT = 0.15  # How much a remembered choice can lift a candidate's score
+PHONETIC_BOOST = 0.1 # How much sounding alike can lift a candidate; never enough to pass MATCH_CUTOFF alone
+PHONETIC_MIN_LENGTH = 4 # Shorter words collide too easily under Soundex ("chat" and "code")
+
+# How strongly each .desktop field counts towards a match.
+FIELD_WEIGHTS = {
+    'name': 1.0,
+    'exec_name': 0.9,
+    'localized_names': 0.9,
+    'generic_name': 0.85,
+    'localized_generic_names': 0.8,
+    'keywords': 0.75,
+}
+
+_SOUNDEX_CODES = {}
+for _letters, _code in (('bfpv', '1'), ('cgjkqsxz', '2'), ('dt', '3'), ('l', '4'), ('mn', '5'), ('r', '6')):
+    for _letter in _letters:
+        _SOUNDEX_CODES[_letter] = _code
+
+def normalize(text):
+    """Lowercases and reduces text to space-separated alphanumeric words."""
+    return ' '.join(re.findall(r'\w+', text.lower()))
+
+def trigrams(text):
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def soundex(word):
+    """Classic four-character Soundex, enough to catch most STT misspellings."""
+    if not word:
+        return ''
+    first = word[0]
+    code = first.upper()
+    previous = _SOUNDEX_CODES.get(first)
+    for letter in word[1:]:
+        digit = _SOUNDEX_CODES.get(letter)
+        if digit and digit != previous:
+            code += digit
+            if len(code) == 4:
+                break
+        if letter not in 'hw':
+            previous = digit
+    return code.ljust(4, '0')
+
+def phonetic_keys(text):
+    """The Soundex codes of the words in text long enough to be compared phonetically."""
+    return {soundex(word) for word in text.split() if len(word) >= PHONETIC_MIN_LENGTH}
+
+class UsageStore:
+    """Remembers which application the user actually launched for each spoken query."""
+    def __init__(self, path=USAGE_FILE_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                self.choices = json.load(f)
+        except (OSError, ValueError):
+            self.choices = {}
+
+    def count(self, query, app_key):
+        return self.choices.get(query, {}).get(app_key, 0)
+
+    def record(self, query, app_key):
+        with self.lock:
+            counts = self.choices.setdefault(query, {})
+            counts[app_key] = counts.get(app_key, 0) + 1
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                tmp_path = f"{self.path}.tmp"
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump(self.choices, f)
+                os.replace(tmp_path, self.path)
+            except OSError as e:
+                print(f"Could not save app usage: {e}")
+
+class AppMatcher:
+    """
+    A prebuilt trigram and phonetic index over every searchable field of the
+    installed applications (name, localized names, generic names, keywords and
+    the Exec basename). Building it is linear in the catalogue; a lookup only
+    scores the candidates that share a trigram or a phonetic key with the query.
+    Candidates are scored by trigram similarity; sounding alike only adds a
+    small boost, so a phonetic collision alone never launches anything.
+    """
+    def __init__(self, applications, usage=None):
+        self.applications = applications # The catalogue this index was built from; match() keys into it
+        self.usage = usage
+        self.terms = []         # (normalized text, trigram count, app key, weight)
+        self.trigram_index = {} # trigram -> [term id, ...]
+        self.phonetic_index = {} # Soundex code of a word -> [term id, ...]
+        for app_key, app in applications.items():
+            for field, weight in FIELD_WEIGHTS.items():
+                values = app.get(field) or []
+                if isinstance(values, str):
+                    values = [values]
+                for value in values:
+                    self.add_term(normalize(value), app_key, weight)
+
+    def add_term(self, text, app_key, weight):
+        if not text:
+            return
+        term_id = len(self.terms)
+        grams = trigrams(text)
+        self.terms.append((text, len(grams), app_key, weight))
+        for gram in grams:
+            self.trigram_index.setdefault(gram, []).append(term_id)
+        for code in phonetic_keys(text):
+            self.phonetic_index.setdefault(code, []).append(term_id)
+
+    def match(self, query, k=5):
+        """Returns up to k (app key, score) pairs, best first."""
+        query = normalize(query)
+        if not query:
+            return []
+        query_grams = trigrams(query)
+
+        shared = {}
+        for gram in query_grams:
+            for term_id in self.trigram_index.get(gram, ()):
+                shared[term_id] = shared.get(term_id, 0) + 1
+        query_codes = phonetic_keys(query)
+        phonetic_hits = {} # term id -> query words it sounds like
+        for code in query_codes:
+            for term_id in self.phonetic_index.get(code, ()):
+                phonetic_hits[term_id] = phonetic_hits.get(term_id, 0) + 1
+
+        scores = {}
+        for term_id in shared.keys() | phonetic_hits.keys():
+            text, gram_count, app_key, weight = self.terms[term_id]
+            similarity = 2.0 * shared.get(term_id, 0) / (len(query_grams) + gram_count)
+            if term_id in phonetic_hits:
+                similarity = min(1.0, similarity + PHONETIC_BOOST * phonetic_hits[term_id] / len(query_codes))
+            score = similarity * weight
+            if score > scores.get(app_key, 0.0):
+                scores[app_key] = score
+
+        if self.usage is not None:
+            for app_key in scores:
+                count = self.usage.count(query, app_key)
+                if count:
+                    scores[app_key] += USAGE_WEIGHT * min(1.0, math.log1p(count) / math.log1p(5))
+
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
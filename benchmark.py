@@ -0,0 +1,334 @@
+# benchmark.py
+#
+# Offline end-to-end benchmark: drives wakeword -> VAD/capture -> STT -> intent
+# -> TTS from a recorded WAV file, against local stand-ins for the chat and
+# audio APIs, and reports per-stage latency, CPU and RSS. Runs headless: audio
+# "playback" is piped into `cat` and nothing touches a sound device.
+#
+#   python benchmark.py recording.wav --turns 10 --speed 0
+#   python benchmark.py recording.wav --model model.tflite --speed 1 --json results.json
+
+import os
+import sys
+import json
+import time
+import wave
+import queue
+import shutil
+import argparse
+import tempfile
+import collections
+import multiprocessing
+import http.server
+
+import numpy as np
+
+import metrics
+
+# --- Stand-in Services ---
+def make_stub_handler(config):
+    """Builds a request handler answering like GEMINI_API_URL and AUDIO_API_URL, at configurable rates."""
+    class StubHandler(http.server.BaseHTTPRequestHandler):
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length', 0))
+            try:
+                body = json.loads(self.rfile.read(length) or b'{}')
+            except ValueError:
+                body = {}
+            if self.path == '/api/chat':
+                self.stream_chat()
+            elif self.path == '/api/summarize-history':
+                self.send_json({"summarized_history": body.get('history', [])[-4:]})
+            else:
+                self.stream_audio(body.get('text', ''))
+
+        def send_json(self, data):
+            payload = json.dumps(data).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def stream_chat(self):
+            # HTTP/1.0 without Content-Length: the body streams until the connection closes.
+            time.sleep(config['llm_latency'])
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; charset=utf-8')
+            self.end_headers()
+            for token in f"[intent_chitchat] {config['reply']}".split(' '):
+                self.wfile.write((token + ' ').encode('utf-8'))
+                self.wfile.flush()
+                time.sleep(1.0 / config['llm_tokens_per_sec'])
+
+        def stream_audio(self, text):
+            time.sleep(config['tts_latency'])
+            self.send_response(200)
+            self.send_header('Content-Type', 'audio/mpeg')
+            self.end_headers()
+            remaining = max(1, len(text)) * config['tts_bytes_per_char']
+            chunk = b'\0' * 4096
+            while remaining > 0:
+                size = min(len(chunk), remaining)
+                self.wfile.write(chunk[:size])
+                self.wfile.flush()
+                remaining -= size
+                time.sleep(size / config['tts_bytes_per_sec'])
+
+        def log_message(self, format, *args):
+            pass # Keep the benchmark output readable
+    return StubHandler
+
+def serve_stubs(config, port_queue):
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), make_stub_handler(config))
+    port_queue.put(server.server_address[1])
+    server.serve_forever()
+
+def start_stub_process(config):
+    """Runs the stand-ins in their own process, so their CPU time is not billed to any stage."""
+    port_queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=serve_stubs, args=(config, port_queue), daemon=True)
+    process.start()
+    return process, f"http://127.0.0.1:{port_queue.get(timeout=10)}"
+
+# --- Audio Input ---
+def load_wav(path, rate):
+    """Reads a 16-bit WAV file as mono int16 samples at `rate` Hz."""
+    with wave.open(path, 'rb') as wav:
+        if wav.getsampwidth() != 2:
+            raise ValueError(f"{path}: only 16-bit PCM WAV files are supported")
+        channels, source_rate = wav.getnchannels(), wav.getframerate()
+        samples = np.frombuffer(wav.readframes(wav.getnframes()), dtype=np.int16)
+    samples = samples.reshape(-1, channels).mean(axis=1)
+    if source_rate != rate:
+        positions = np.arange(0, len(samples), source_rate / rate)
+        samples = np.interp(positions, np.arange(len(samples)), samples)
+    return samples.astype(np.int16)
+
+class PacedAudio:
+    """Serves fixed-size chunks of a recording, no faster than `speed` x real time (0 = unpaced)."""
+    def __init__(self, samples, rate, chunk_size, speed, offset=0):
+        self.samples = samples
+        self.rate = rate
+        self.chunk_size = chunk_size
+        self.speed = speed
+        self.position = offset
+        self.started_at = time.monotonic()
+        self.start_position = offset
+
+    def read_chunk(self):
+        chunk = self.samples[self.position:self.position + self.chunk_size]
+        if len(chunk) < self.chunk_size:
+            return b''
+        self.position += self.chunk_size
+        if self.speed > 0:
+            due = self.started_at + (self.position - self.start_position) / self.rate / self.speed
+            delay = due - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        return chunk.tobytes()
+
+# --- Measurement ---
+class StageMeter:
+    """Accumulates wall time, CPU time and RSS for each stage across turns."""
+    def __init__(self):
+        self.samples = collections.OrderedDict()
+
+    def measure(self, stage):
+        return _StageMeasurement(self, stage)
+
+    def record(self, stage, wall, cpu, rss_kb, peak_kb):
+        self.samples.setdefault(stage, []).append((wall, cpu, rss_kb, peak_kb))
+
+class _StageMeasurement:
+    def __init__(self, meter, stage):
+        self.meter = meter
+        self.stage = stage
+
+    def __enter__(self):
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+        return self
+
+    def __exit__(self, *exc_info):
+        rss_kb, peak_kb = metrics.read_rss_kb()
+        self.meter.record(self.stage, time.perf_counter() - self.wall, time.process_time() - self.cpu, rss_kb, peak_kb)
+        return False
+
+# --- Pipeline ---
+def run_turn(args, samples_16k, samples_wakeword, meter, text_queue):
+    """Drives one turn through every stage. Returns its turn ID."""
+    import tm_model
+    import vad
+    import intent
+    import tts_online
+
+    # --- Wakeword ---
+    with meter.measure('wakeword'):
+        wake_offset = int(args.wake_at * vad.RATE)
+        started_at = time.monotonic()
+        confidence = 1.0
+        if args.model:
+            block = tm_model.CHUNK_SIZE
+            audio = PacedAudio(samples_wakeword, tm_model.SAMPLE_RATE, block, args.speed)
+            while True:
+                raw = audio.read_chunk()
+                if not raw:
+                    raise RuntimeError("The wakeword was not detected in the recording")
+                started_at = time.monotonic()
+                chunk = np.frombuffer(raw, dtype=np.int16).astype(np.float32)[:, None] / 32768.0
+                confidence = tm_model.detect_wakeword(chunk)
+                if confidence is not None:
+                    wake_offset = int(audio.position * vad.RATE / tm_model.SAMPLE_RATE)
+                    break
+        turn = tm_model.start_turn(started_at, confidence)
+
+    # --- Capture, endpointing and STT ---
+    with meter.measure('capture+stt'):
+        audio = PacedAudio(samples_16k, vad.RATE, vad.CHUNK_SIZE, args.speed, offset=wake_offset)
+        if args.stt == 'google':
+            transcriber = vad.transcribe
+        else:
+            def transcriber(wav_data):
+                time.sleep(args.stt_latency)
+                return args.transcript
+        vad.main(turn=turn, read_chunk=audio.read_chunk, transcriber=transcriber)
+
+    # --- Intent (reached over the bus, like the real logic loop) ---
+    with meter.measure('intent'):
+        user_input, message_turn = text_queue.get(timeout=10)
+        intent.process_text_input(user_input, message_turn)
+
+    # --- TTS ---
+    with meter.measure('tts'):
+        # process_text_input has returned, so any reply is already on disk; don't wait for one.
+        # An empty file means "nothing to say" (app launches, --reply ''), which wait_for_reply()
+        # would keep polling past, so it is cleared here instead.
+        reply = None
+        if os.path.exists(tts_online.INPUT_FILE_NAME):
+            if os.path.getsize(tts_online.INPUT_FILE_NAME) > 0:
+                reply = tts_online.wait_for_reply()
+            else:
+                os.remove(tts_online.INPUT_FILE_NAME)
+        if reply:
+            tts_online.speak_reply(*reply) # Traced under the turn the reply carries
+            os.remove(tts_online.CLAIMED_FILE_NAME)
+    return turn
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline end-to-end benchmark of the Ketta pipeline.")
+    parser.add_argument('wav', help="16-bit WAV recording of the wakeword followed by a command")
+    parser.add_argument('--turns', type=int, default=5, help="back-to-back turns to run")
+    parser.add_argument('--speed', type=float, default=1.0, help="audio feed rate vs real time (0 = unpaced)")
+    parser.add_argument('--model', help="TFLite wakeword model; without it the wakeword is assumed at --wake-at")
+    parser.add_argument('--labels', default='labels.txt')
+    parser.add_argument('--wake-at', type=float, default=0.0, help="seconds into the recording the command starts")
+    parser.add_argument('--stt', choices=('stub', 'google'), default='stub')
+    parser.add_argument('--stt-latency', type=float, default=0.3)
+    parser.add_argument('--transcript', default="what's the weather like today")
+    parser.add_argument('--llm-latency', type=float, default=0.4, help="seconds to the first token")
+    parser.add_argument('--llm-tokens-per-sec', type=float, default=50.0)
+    parser.add_argument('--reply', default="It looks sunny and warm today. Enjoy the afternoon outside!")
+    parser.add_argument('--tts-latency', type=float, default=0.25, help="seconds to the first audio byte")
+    parser.add_argument('--tts-bytes-per-sec', type=float, default=64000.0)
+    parser.add_argument('--tts-bytes-per-char', type=int, default=400)
+    parser.add_argument('--no-cache', action='store_true', help="disable the response cache, so every turn calls the model")
+    parser.add_argument('--json', help="also write the results to this file")
+    args = parser.parse_args(argv)
+
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    wav_path = os.path.abspath(args.wav)
+    model_path = os.path.abspath(args.model) if args.model else None
+    labels_path = os.path.abspath(args.labels)
+    json_path = os.path.abspath(args.json) if args.json else None # Resolved before we chdir away
+    work_dir = tempfile.mkdtemp(prefix='ketta-bench-')
+
+    stub_process, stub_url = start_stub_process({
+        'llm_latency': args.llm_latency, 'llm_tokens_per_sec': args.llm_tokens_per_sec, 'reply': args.reply,
+        'tts_latency': args.tts_latency, 'tts_bytes_per_sec': args.tts_bytes_per_sec,
+        'tts_bytes_per_char': args.tts_bytes_per_char,
+    })
+
+    meter = StageMeter()
+    startup_rss_kb = metrics.read_rss_kb()[0]
+    with meter.measure('imports'):
+        # Everything below writes output.txt, the history file and traces relative to the
+        # working directory, so run in a scratch directory and leave the checkout alone.
+        sys.path.insert(0, repo_dir)
+        os.chdir(work_dir)
+        import bus
+        bus.BUS_SOCKET_PATH = os.path.join(work_dir, 'bus.sock')
+        bus.BUS_LOCK_PATH = os.path.join(work_dir, 'bus.lock')
+        import tracing
+        tracing.TRACE_FILE = os.path.join(work_dir, 'trace.jsonl')
+        import tm_model
+        import vad
+        import intent
+        import tts_online
+        intent.GEMINI_API_URL = stub_url
+        tts_online.AUDIO_API_URL = f"{stub_url}/api/generate-audio-stream"
+        tts_online.PLAYER_COMMAND = ['cat'] # Headless sink that still drains the pipe
+        if args.no_cache:
+            intent.responses.max_entries = 0
+    with meter.measure('model load'):
+        if model_path:
+            tm_model.load_model(model_path, labels_path)
+
+    bus.ensure_broker()
+    text_queue = queue.Queue()
+    bus.subscribe(bus.TOPIC_STT_TEXT, lambda text, message: text_queue.put((text, message.get('turn'))))
+    bus.subscribe(bus.TOPIC_STT_PARTIAL, intent.handle_partial_text)
+
+    samples_16k = load_wav(wav_path, vad.RATE)
+    samples_wakeword = load_wav(wav_path, tm_model.SAMPLE_RATE) if model_path else None
+
+    turns = []
+    started = time.perf_counter()
+    try:
+        for i in range(args.turns):
+            print(f"\n=== Turn {i + 1}/{args.turns} ===")
+            turns.append(run_turn(args, samples_16k, samples_wakeword, meter, text_queue))
+    finally:
+        elapsed = time.perf_counter() - started
+        stub_process.terminate()
+
+    traced = tracing.load_turns(tracing.TRACE_FILE)
+    intervals = tracing.aggregate(collections.OrderedDict((t, traced.get(t, [])) for t in turns))
+    results = {
+        'turns': len(turns),
+        'elapsed_s': elapsed,
+        'turns_per_min': 60.0 * len(turns) / elapsed if elapsed else 0.0,
+        'startup_rss_mb': startup_rss_kb / 1024,
+        'response_cache': intent.get_cache_stats(),
+        'intervals_ms': {name: metrics.summarize(values) for name, values in intervals.items()},
+        'stages': {
+            stage: {
+                'wall_ms': metrics.summarize([s[0] * 1000 for s in samples]),
+                'cpu_ms': metrics.summarize([s[1] * 1000 for s in samples]),
+                'rss_mb': samples[-1][2] / 1024,
+                'peak_rss_mb': samples[-1][3] / 1024,
+            } for stage, samples in meter.samples.items()
+        },
+    }
+
+    print(f"\n=== {len(turns)} turns in {elapsed:.1f} s ({results['turns_per_min']:.1f} turns/min) ===")
+    cache = results['response_cache']
+    print(f"response cache: {cache['hits']} hits / {cache['misses']} misses, {cache['speculative_confirmed']} "
+          f"speculative requests confirmed, {cache['seconds_saved'] * 1000:.0f} ms of model time saved")
+    print(f"{'stage':<14}{'wall p50':>10}{'wall max':>10}{'cpu p50':>10}{'rss MB':>9}{'peak MB':>9}")
+    for stage, data in results['stages'].items():
+        print(f"{stage:<14}{data['wall_ms']['p50']:>10.0f}{data['wall_ms']['max']:>10.0f}"
+              f"{data['cpu_ms']['p50']:>10.0f}{data['rss_mb']:>9.1f}{data['peak_rss_mb']:>9.1f}")
+    print(f"\n{'interval':<28}{'p50':>9}{'p90':>9}{'max':>9}  (ms)")
+    for name, data in results['intervals_ms'].items():
+        print(f"{name:<28}{data['p50']:>9.0f}{data['p90']:>9.0f}{data['max']:>9.0f}")
+
+    if json_path:
+        with open(json_path, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+        print(f"\nResults written to {json_path}")
+    shutil.rmtree(work_dir, ignore_errors=True)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
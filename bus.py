@@ -0,0 +1,438 @@
+# bus.py
+
+import os
+import sys
+import json
+import time
+import queue
+import fcntl
+import socket
+import struct
+import tempfile
+import threading
+import collections
+import metrics
+
+# --- Configuration ---
+RUNTIME_DIR = os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir()
+BUS_SOCKET_PATH = os.path.join(RUNTIME_DIR, 'ketta-bus.sock')
+BUS_LOCK_PATH = os.path.join(RUNTIME_DIR, 'ketta-bus.lock') # Held by whichever process hosts the broker
+RECONNECT_INTERVAL = 0.5  # Seconds between reconnection attempts
+ACK_TIMEOUT = 1.0         # Seconds publish(..., ack=True) waits for the broker
+MAX_FRAME_SIZE = 1 << 20
+SUBSCRIBER_QUEUE_SIZE = 256 # Frames the broker buffers per subscriber before dropping
+
+# --- Topics ---
+# Every topic carries one payload type; publish() rejects anything else.
+TOPIC_UI_COMMAND = 'ui.command'   # str: 'show', 'hide', or a mode for the orb
+TOPIC_UI_LOUDNESS = 'ui.loudness' # float: microphone loudness, 0.0 - 1.0
+TOPIC_TTS_COMMAND = 'tts.command' # str: 'stop_audio'
+TOPIC_STT_TEXT = 'stt.text'       # str: a transcript, or one of the __error__ codes
+TOPIC_STT_PARTIAL = 'stt.partial' # str: an early transcript, taken when the speaker pauses
+TOPIC_TYPES = {
+    TOPIC_UI_COMMAND: str,
+    TOPIC_UI_LOUDNESS: float,
+    TOPIC_TTS_COMMAND: str,
+    TOPIC_STT_TEXT: str,
+    TOPIC_STT_PARTIAL: str,
+}
+
+_HEADER = struct.Struct('>I')
+
+def send_frame(sock, message):
+    body = json.dumps(message, separators=(',', ':')).encode('utf-8')
+    sock.sendall(_HEADER.pack(len(body)) + body)
+
+def _recv_exact(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("Bus connection closed")
+        data += chunk
+    return data
+
+def recv_frame(sock):
+    """Reads one length-prefixed JSON frame. Raises ValueError for a malformed frame."""
+    (size,) = _HEADER.unpack(_recv_exact(sock, _HEADER.size))
+    if size > MAX_FRAME_SIZE:
+        raise ConnectionError(f"Bus frame of {size} bytes exceeds the limit")
+    message = json.loads(_recv_exact(sock, size).decode('utf-8'))
+    if not isinstance(message, dict) or 'kind' not in message:
+        raise ValueError("Bus frame is not a message")
+    return message
+
+# --- Broker ---
+class BrokerConnection:
+    def __init__(self, broker, sock):
+        self.broker = broker
+        self.sock = sock
+        self.name = '?'
+        self.outbox = queue.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        self.closed = False
+        threading.Thread(target=self.write_loop, daemon=True).start()
+        threading.Thread(target=self.read_loop, daemon=True).start()
+
+    def enqueue(self, message):
+        """Queues a frame for this client. Returns False if the client is too far behind."""
+        try:
+            self.outbox.put_nowait(message)
+            return True
+        except queue.Full:
+            return False
+
+    def write_loop(self):
+        try:
+            while not self.closed:
+                message = self.outbox.get()
+                if message is None:
+                    break
+                send_frame(self.sock, message)
+        except OSError:
+            pass
+        self.close()
+
+    def read_loop(self):
+        try:
+            while True:
+                try:
+                    message = recv_frame(self.sock)
+                except ValueError:
+                    self.broker.stats['malformed'] += 1
+                    continue
+                self.broker.handle(self, message)
+        except (OSError, ConnectionError, struct.error):
+            pass
+        self.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.broker.remove(self)
+        try:
+            self.outbox.put_nowait(None)
+        except queue.Full:
+            pass
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+class Broker:
+    """Routes published messages to the connections subscribed to their topic."""
+    def __init__(self, path=None):
+        self.path = path or BUS_SOCKET_PATH
+        self.lock = threading.Lock()
+        self.subscriptions = collections.defaultdict(set) # topic -> {BrokerConnection}
+        self.connections = set()
+        self.stats = collections.Counter()
+
+    def serve_forever(self, server_sock):
+        while True:
+            conn_sock, _ = server_sock.accept()
+            with self.lock:
+                self.connections.add(BrokerConnection(self, conn_sock))
+
+    def handle(self, connection, message):
+        kind = message.get('kind')
+        if kind == 'hello':
+            connection.name = str(message.get('src', '?'))
+        elif kind == 'sub':
+            with self.lock:
+                self.subscriptions[message.get('topic')].add(connection)
+        elif kind == 'pub':
+            with self.lock:
+                subscribers = list(self.subscriptions.get(message.get('topic'), ()))
+            delivered = 0
+            for subscriber in subscribers:
+                if subscriber.enqueue(message):
+                    delivered += 1
+                else:
+                    self.stats['dropped'] += 1
+            self.stats['routed'] += 1
+            if message.get('ack'):
+                connection.enqueue({'kind': 'ack', 'seq': message.get('seq'), 'delivered': delivered})
+        else:
+            self.stats['malformed'] += 1
+
+    def remove(self, connection):
+        with self.lock:
+            self.connections.discard(connection)
+            for subscribers in self.subscriptions.values():
+                subscribers.discard(connection)
+
+_broker_lock_file = None
+_broker = None # The Broker this process hosts, if any
+
+def ensure_broker(path=None):
+    """
+    Makes sure a broker is running, hosting it on a daemon thread of this
+    process if nobody else does. Ownership is decided by an flock on
+    BUS_LOCK_PATH, so exactly one process hosts the broker and another one
+    takes over as soon as it exits. Returns True if this process hosts it.
+    """
+    global _broker_lock_file, _broker
+    path = path or BUS_SOCKET_PATH
+    get_client().may_host_broker = True
+    if _broker_lock_file is not None:
+        return True
+    lock_file = open(BUS_LOCK_PATH, 'a')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return False # Another process hosts the broker
+
+    # Holding the lock means any socket file left behind is stale.
+    if os.path.exists(path):
+        os.unlink(path)
+    server_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server_sock.bind(path)
+    server_sock.listen()
+    _broker_lock_file = lock_file
+    _broker = Broker(path)
+    threading.Thread(target=_broker.serve_forever, args=(server_sock,), daemon=True).start()
+    print(f"Hosting the message bus on {path}")
+    return True
+
+# --- Client ---
+class BusClient:
+    """
+    A persistent connection to the broker. Messages carry the sender's name
+    and per-topic sequence numbers, so subscribers can detect dropped messages, and a
+    publisher can ask the broker to acknowledge delivery. Messages may also
+    carry the ID of the turn they belong to. Subscription
+    callbacks run on the client's reader thread.
+    """
+    def __init__(self, name, path=None):
+        self.name = name
+        self.path = path or BUS_SOCKET_PATH
+        self.lock = threading.Lock()
+        self.sock = None
+        self.seq = 0
+        self.callbacks = collections.defaultdict(list) # topic -> [callback(data, message)]
+        self.pending_acks = {} # seq -> [threading.Event, delivered count, sent at]
+        self.topic_seq = collections.Counter() # topic -> last per-topic sequence number sent
+        self.last_seq = {} # (sender, topic) -> last per-topic sequence number seen
+        self.may_host_broker = False
+        self.reconnecting = False
+        self.reader_thread = None
+        self.warned_unavailable = False
+        self.stats = collections.Counter()
+        self.ack_rtts = collections.deque(maxlen=1000)
+        self.delivery_latencies = collections.deque(maxlen=1000)
+
+    def connect(self):
+        """Connects and re-subscribes. Must be called with self.lock held."""
+        if self.sock is not None:
+            return True
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.path)
+            send_frame(sock, {'kind': 'hello', 'src': self.name})
+            for topic in self.callbacks:
+                send_frame(sock, {'kind': 'sub', 'topic': topic})
+        except OSError:
+            sock.close()
+            return False
+        self.sock = sock
+        self.warned_unavailable = False
+        self.reader_thread = threading.Thread(target=self.read_loop, args=(sock,), daemon=True)
+        self.reader_thread.start()
+        return True
+
+    def disconnect(self, sock):
+        with self.lock:
+            if self.sock is sock:
+                self.sock = None
+            try:
+                sock.close()
+            except OSError:
+                pass
+            if self.callbacks and not self.reconnecting:
+                # Subscribers must come back on their own; publishers reconnect on demand.
+                self.reconnecting = True
+                threading.Thread(target=self.reconnect_loop, daemon=True).start()
+
+    def reconnect_loop(self):
+        while True:
+            time.sleep(RECONNECT_INTERVAL)
+            if self.may_host_broker:
+                ensure_broker(self.path)
+            with self.lock:
+                if self.connect():
+                    self.reconnecting = False
+                    return
+
+    def subscribe(self, topic, callback):
+        """Calls callback(data, message) for every message published on topic."""
+        with self.lock:
+            first = topic not in self.callbacks
+            self.callbacks[topic].append(callback)
+            if self.sock is None:
+                if not self.connect() and not self.reconnecting:
+                    self.reconnecting = True
+                    threading.Thread(target=self.reconnect_loop, daemon=True).start()
+            elif first:
+                try:
+                    send_frame(self.sock, {'kind': 'sub', 'topic': topic})
+                except OSError:
+                    pass # The reader thread notices and reconnects, re-subscribing everything
+
+    def publish(self, topic, data, ack=False, turn=None):
+        """
+        Publishes data on topic. Returns False if it could not be handed to the
+        broker or, with ack=True, if the broker did not confirm it in time or
+        had no subscriber to deliver it to.
+        Subscription callbacks cannot wait for acks, since acks arrive on their thread.
+        """
+        if ack and threading.current_thread() is self.reader_thread:
+            raise RuntimeError("Cannot wait for a bus ack from a subscription callback")
+        expected_type = TOPIC_TYPES.get(topic)
+        if expected_type is float and isinstance(data, int):
+            data = float(data)
+        if expected_type is not None and not isinstance(data, expected_type):
+            raise TypeError(f"Topic '{topic}' carries {expected_type.__name__}, not {type(data).__name__}")
+
+        with self.lock:
+            self.seq += 1
+            self.topic_seq[topic] += 1
+            # 'seq' identifies the message for acks; 'tseq' numbers it within its topic, so a
+            # subscriber can spot losses without counting the topics it never subscribed to.
+            message = {'kind': 'pub', 'topic': topic, 'data': data, 'src': self.name,
+                       'seq': self.seq, 'tseq': self.topic_seq[topic], 'ts': time.monotonic(),
+                       'ack': ack, 'turn': turn}
+            if ack:
+                pending = self.pending_acks[self.seq] = [threading.Event(), 0, time.perf_counter()]
+            try:
+                if not self.connect():
+                    raise ConnectionError("No message bus is running")
+                send_frame(self.sock, message)
+                self.stats['published'] += 1
+            except (OSError, ConnectionError) as e:
+                self.stats['undelivered'] += 1
+                self.pending_acks.pop(message['seq'], None)
+                if not self.warned_unavailable:
+                    # Warn once per outage; loudness alone would otherwise print 30 times a second.
+                    print(f"Message bus unavailable, dropping '{topic}' messages: {e}")
+                    self.warned_unavailable = True
+                return False
+
+        if not ack:
+            return True
+        acked = pending[0].wait(ACK_TIMEOUT)
+        with self.lock:
+            self.pending_acks.pop(message['seq'], None)
+        if not acked:
+            self.stats['ack_timeouts'] += 1
+            return False
+        if pending[1] == 0:
+            self.stats['unrouted'] += 1 # The broker got it, but nobody is subscribed
+            return False
+        return True
+
+    def read_loop(self, sock):
+        try:
+            while True:
+                try:
+                    message = recv_frame(sock)
+                except ValueError:
+                    self.stats['malformed'] += 1
+                    continue
+                self.dispatch(message)
+        except (OSError, ConnectionError, struct.error):
+            pass
+        self.disconnect(sock)
+
+    def dispatch(self, message):
+        if message['kind'] == 'ack':
+            pending = self.pending_acks.get(message.get('seq'))
+            if pending is not None:
+                pending[1] = message.get('delivered', 0)
+                self.ack_rtts.append(time.perf_counter() - pending[2])
+                self.stats['acked'] += 1
+                pending[0].set()
+            return
+        if message['kind'] != 'pub':
+            return
+
+        stream, seq = (message.get('src'), message.get('topic')), message.get('tseq')
+        last = self.last_seq.get(stream)
+        if last is not None and isinstance(seq, int) and seq != last + 1:
+            # The broker drops frames for subscribers that fall behind; count what we missed.
+            self.stats['gaps'] += max(0, seq - last - 1)
+        self.last_seq[stream] = seq
+        self.stats['received'] += 1
+        if isinstance(message.get('ts'), (int, float)):
+            self.delivery_latencies.append(time.monotonic() - message['ts'])
+
+        for callback in list(self.callbacks.get(message.get('topic'), ())):
+            try:
+                callback(message.get('data'), message)
+            except Exception as e:
+                print(f"Error in bus subscriber for '{message.get('topic')}': {e}")
+
+    def get_stats(self):
+        """Returns message counts plus ack round-trip and delivery latency summaries (seconds)."""
+        stats = dict(self.stats)
+        stats['ack_rtt'] = metrics.summarize(self.ack_rtts)
+        stats['delivery_latency'] = metrics.summarize(self.delivery_latencies)
+        return stats
+
+_client = None
+_client_lock = threading.Lock()
+
+def get_client():
+    """Returns this process's shared bus connection."""
+    global _client
+    with _client_lock:
+        if _client is None:
+            name = f"{os.path.splitext(os.path.basename(sys.argv[0] or 'python'))[0]}-{os.getpid()}"
+            _client = BusClient(name)
+        return _client
+
+def publish(topic, data, ack=False, turn=None):
+    return get_client().publish(topic, data, ack=ack, turn=turn)
+
+def subscribe(topic, callback):
+    get_client().subscribe(topic, callback)
+
+# --- Metrics ---
+# Read from the existing stats counters at scrape time, so publishing pays nothing extra.
+def _broker_stat(key):
+    return _broker.stats[key] if _broker is not None else 0
+
+def _client_stat(key):
+    return _client.stats[key] if _client is not None else 0
+
+def _subscriber_backlog():
+    if _broker is None:
+        return 0
+    with _broker.lock:
+        connections = list(_broker.connections)
+    return max((connection.outbox.qsize() for connection in connections), default=0)
+
+metrics.counter('ketta_bus_malformed_total', "Malformed frames received by the broker or this process",
+                fn=lambda: _broker_stat('malformed') + _client_stat('malformed'))
+metrics.counter('ketta_bus_dropped_total', "Messages the broker dropped for subscribers that fell behind",
+                fn=lambda: _broker_stat('dropped'))
+metrics.counter('ketta_bus_gaps_total', "Messages this process missed, from gaps in sequence numbers",
+                fn=lambda: _client_stat('gaps'))
+metrics.counter('ketta_bus_undelivered_total', "Messages this process could not hand to the broker",
+                fn=lambda: _client_stat('undelivered'))
+metrics.counter('ketta_bus_ack_timeouts_total', "Acknowledged publishes that timed out",
+                fn=lambda: _client_stat('ack_timeouts'))
+metrics.gauge('ketta_bus_subscriber_backlog', "Frames queued by the broker for its slowest subscriber",
+              fn=_subscriber_backlog)
+
+if __name__ == "__main__":
+    if not ensure_broker():
+        print(f"A message bus is already running on {BUS_SOCKET_PATH}.")
+        sys.exit(1)
+    metrics.start()
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        print("\nMessage bus stopped.")
@@ -1,31 +1,25 @@
 # control.py
 
-import socket
 import sys
+import bus
 
-# --- Configuration ---
-# Define the unique ports for each application
-HOST = "127.0.0.1"  # Use localhost for both
-UI_COMMAND_UDP_PORT = 45454   # Port for the main UI application (app.py)
-TTS_COMMAND_UDP_PORT = 45456  # Port for the TTS audio player script
-
-def send_ui_command(command: str):
-    """Sends a command to the UI application (app.py)."""
-    try:
-        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
-            sock.sendto(command.encode('utf-8'), (HOST, UI_COMMAND_UDP_PORT))
+def send_ui_command(command: str, ack: bool = False, turn: str = None):
+    """Sends a command to the UI application (app.py). Returns False if it was not delivered."""
+    delivered = bus.publish(bus.TOPIC_UI_COMMAND, command, ack=ack, turn=turn)
+    if delivered:
         print(f"Sent UI command: '{command}'")
-    except Exception as e:
-        print(f"Error sending command to UI: {e}")
+    else:
+        print(f"Error sending command to UI: '{command}' was not delivered")
+    return delivered
 
-def send_tts_command(command: str):
-    """Sends a command to the TTS audio player script."""
-    try:
-        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
-            sock.sendto(command.encode('utf-8'), (HOST, TTS_COMMAND_UDP_PORT))
+def send_tts_command(command: str, ack: bool = False):
+    """Sends a command to the TTS audio player script. Returns False if it was not delivered."""
+    delivered = bus.publish(bus.TOPIC_TTS_COMMAND, command, ack=ack)
+    if delivered:
         print(f"Sent TTS command: '{command}'")
-    except Exception as e:
-        print(f"Error sending command to TTS: {e}")
+    else:
+        print(f"Error sending command to TTS: '{command}' was not delivered")
+    return delivered
 
 if __name__ == "__main__":
     if len(sys.argv) < 3:
@@ -42,10 +36,11 @@ if __name__ == "__main__":
     target = sys.argv[1].lower()
     command_to_send = sys.argv[2].lower()
 
+    # Wait for the broker's acknowledgement, so the exit status says whether the command got through.
     if target == 'ui':
-        send_ui_command(command_to_send)
+        sys.exit(0 if send_ui_command(command_to_send, ack=True) else 1)
     elif target == 'tts':
-        send_tts_command(command_to_send)
+        sys.exit(0 if send_tts_command(command_to_send, ack=True) else 1)
     else:
         print(f"Error: Invalid target '{target}'. Use 'ui' or 'tts'.")
         sys.exit(1)
@@ -0,0 +1,28 @@
+# http_client.py
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import metrics
+
+# --- Configuration ---
+CONNECT_RETRIES = 2 # Only failures before the request was sent are retried, so a POST never runs twice
+RETRY_BACKOFF = 0.2 # Seconds; doubles with each retry
+
+retry_counter = metrics.counter('ketta_http_retries_total', "HTTP requests retried after a connection failure")
+
+class CountingRetry(Retry):
+    """A Retry that counts every retry it allows. urllib3 copies it with type(self), so the subclass sticks."""
+    def increment(self, *args, **kwargs):
+        new_retry = super().increment(*args, **kwargs) # Raises once the retries are used up
+        retry_counter.inc()
+        return new_retry
+
+def make_session():
+    """Returns a requests.Session that retries connection failures and counts the retries."""
+    session = requests.Session()
+    adapter = HTTPAdapter(max_retries=CountingRetry(total=CONNECT_RETRIES, connect=CONNECT_RETRIES, read=0,
+                                                   status=0, redirect=0, backoff_factor=RETRY_BACKOFF))
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
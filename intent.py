@@ -1,20 +1,50 @@
-import requests
 import json
 import os
+import time
 import threading
-import socket
+import queue
+import bus
+import tracing
+import metrics
+import http_client
+import response_cache
 from open_app import launch_application_by_name as launch_app
 from control import send_ui_command
 
 # --- Configuration ---
 GEMINI_API_URL = "http://127.0.0.1:5000"
 HISTORY_FILE = 'conversation_history.json'
+OUTPUT_FILE = 'output.txt' # Read by tts_online.py
 HISTORY_SUMMARIZE_THRESHOLD = 10 
-# Port to listen for transcribed text from the speech script
-TEXT_LISTEN_PORT = 45457 # Must match TEXT_UDP_PORT in the other script
+
+# Reused across turns, so each request skips the TCP/TLS handshake.
+http_session = http_client.make_session()
+
+# --- Metrics ---
+metrics.gauge('ketta_history_file_bytes', "Size of the conversation history file", fn=lambda: os.path.getsize(HISTORY_FILE))
+llm_timer = metrics.timer('ketta_llm_request_seconds', "Duration of each /api/chat request a turn waited on")
+speculation_timer = metrics.timer('ketta_speculative_request_seconds',
+                                  "Duration of each speculative /api/chat request that ran to completion")
+error_counter = metrics.counter('ketta_intent_errors_total', "Turns that failed in the logic loop")
+speculation_confirmed_counter = metrics.counter('ketta_speculative_requests_confirmed_total',
+                                                "Speculative model requests the final transcript confirmed")
+speculation_discarded_counter = metrics.counter('ketta_speculative_requests_discarded_total',
+                                                "Speculative model requests discarded")
+
+# --- Response Cache & Speculation ---
+responses = response_cache.ResponseCache()
+speculation_lock = threading.Lock()
+current_speculation = None # The request started from the latest partial transcript, if any
 
 # --- Helper Functions ---
 
+def write_reply(text, turn=None):
+    """Hands a reply to the TTS script, tagged with its turn. Written whole, then renamed into place."""
+    temp_path = f"{OUTPUT_FILE}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        f.write(tracing.attach_turn(text, turn))
+    os.replace(temp_path, OUTPUT_FILE)
+
 def load_history():
     if not os.path.exists(HISTORY_FILE):
         return []
@@ -55,7 +85,7 @@ def background_summarize_and_save(long_history):
     print("\n(Background Task Started: Summarizing history...)")
     try:
         api_endpoint = f"{GEMINI_API_URL}/api/summarize-history"
-        response = requests.post(api_endpoint, json={"history": long_history}, timeout=120)
+        response = http_session.post(api_endpoint, json={"history": long_history}, timeout=120)
         response.raise_for_status()
         data = response.json()
         if "error" in data:
@@ -70,19 +100,141 @@ def background_summarize_and_save(long_history):
     except Exception as e:
         print(f"(Background Task Error: {e})")
 
+def fetch_response(user_input, history, turn=None, cancel_event=None, timer=llm_timer):
+    """
+    Streams the model's response to user_input. Returns its text, or None if
+    cancel_event was set. Only requests that finish are recorded in `timer`.
+    """
+    api_context = get_system_prompt() + history
+    payload = {"prompt": user_input, "history": api_context}
+    chat_api_endpoint = f"{GEMINI_API_URL}/api/chat"
+
+    full_response_text = ""
+    tracing.mark(turn, 'llm', 'start')
+    started_at = time.perf_counter()
+    with http_session.post(chat_api_endpoint, json=payload, stream=True, timeout=60) as response:
+        response.raise_for_status()
+        for chunk in response.iter_content(chunk_size=None, decode_unicode=True):
+            if cancel_event is not None and cancel_event.is_set():
+                return None
+            if chunk:
+                if not full_response_text:
+                    tracing.mark(turn, 'llm', 'first_token')
+                full_response_text += chunk
+    timer.observe(time.perf_counter() - started_at)
+    tracing.mark(turn, 'llm', 'end')
+    return full_response_text.strip()
+
+class Speculation:
+    """A model request started from a partial transcript, before the user has finished speaking."""
+    def __init__(self, user_input, turn, history):
+        self.user_input = user_input
+        self.key = response_cache.make_key(user_input, history)
+        self.turn = turn
+        self.history = history
+        self.cancel_event = threading.Event()
+        self.done = threading.Event()
+        self.response = None
+        self.started_at = time.monotonic()
+        self.finished_at = None
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        try:
+            # Not traced under the turn: it only becomes part of the turn if it is confirmed.
+            self.response = fetch_response(self.user_input, self.history, cancel_event=self.cancel_event,
+                                           timer=speculation_timer)
+        except Exception as e:
+            print(f"(Speculative request failed: {e})")
+        finally:
+            self.finished_at = time.monotonic()
+            self.done.set()
+
+    def discard(self):
+        self.cancel_event.set()
+        speculation_discarded_counter.inc()
+
+def handle_partial_text(user_input, message):
+    """Bus callback: starts a request on a partial transcript, replacing any earlier speculation."""
+    global current_speculation
+    if user_input.startswith('__'):
+        return # An error code, not speech
+    history = load_history()
+    if responses.lookup(response_cache.make_key(user_input, history), count=False) is not None:
+        return # The final transcript will be answered from the cache anyway
+    speculation = Speculation(user_input, message.get('turn'), history)
+    with speculation_lock:
+        previous, current_speculation = current_speculation, speculation
+    if previous is not None:
+        previous.discard()
+
+def take_speculation(key, turn, history):
+    """
+    Returns the speculative request's (response, seconds it took) if it was
+    made for this turn, utterance and history; otherwise discards it and returns None.
+    """
+    global current_speculation
+    with speculation_lock:
+        speculation, current_speculation = current_speculation, None
+    if speculation is None:
+        return None
+    if speculation.key != key or speculation.turn != turn or speculation.history != history:
+        speculation.discard()
+        return None
+
+    confirmed_at = time.monotonic()
+    speculation.done.wait()
+    if speculation.response is None:
+        speculation_discarded_counter.inc()
+        return None # It failed; the caller makes the request again, and traces that one
+    speculation_confirmed_counter.inc()
+    # Marked only now that it is known to be used, but from when the turn started waiting on it.
+    tracing.mark(turn, 'llm', 'start', t=confirmed_at, speculative=True,
+                 head_start_ms=(confirmed_at - speculation.started_at) * 1000)
+    request_seconds = speculation.finished_at - speculation.started_at
+    responses.saved_counter.inc(min(request_seconds, confirmed_at - speculation.started_at))
+    tracing.mark(turn, 'llm', 'end', speculative=True)
+    return speculation.response, request_seconds
+
+def get_response(user_input, history, turn=None):
+    """Answers from the cache, a confirmed speculative request, or a fresh model request, in that order."""
+    key = response_cache.make_key(user_input, history)
+    cached = responses.lookup(key)
+    if cached is not None:
+        response_text, request_seconds = cached
+        tracing.mark(turn, 'llm', 'start', cached=True)
+        tracing.mark(turn, 'llm', 'end', cached=True)
+        print(f"(Answered from the response cache, saving ~{request_seconds * 1000:.0f} ms.)")
+        return response_text
+
+    result = take_speculation(key, turn, history)
+    if result is not None:
+        response_text, request_seconds = result
+        print("(Answered by the speculative request started on the partial transcript.)")
+    else:
+        started_at = time.monotonic()
+        response_text = fetch_response(user_input, history, turn)
+        request_seconds = time.monotonic() - started_at
+    responses.store(key, response_text, request_seconds)
+    return response_text
+
+def get_cache_stats():
+    stats = responses.get_stats()
+    stats['speculative_confirmed'] = speculation_confirmed_counter.get()
+    stats['speculative_discarded'] = speculation_discarded_counter.get()
+    return stats
+
 # --- Core Logic Function ---
-def process_text_input(user_input: str):
-    """Takes a transcribed text string and runs it through the logic pipeline."""
+def process_text_input(user_input: str, turn: str = None):
+    """Takes a transcribed text string and runs it through the logic pipeline, tracing it under `turn`."""
     print(f"\n--- Processing input: '{user_input}' ---")
 
     # Handle special error codes from the speech script
     if user_input == "__speech_not_understood__":
-        with open('output.txt', 'w', encoding='utf-8') as f:
-            f.write("Sorry, I couldn't quite catch that. Could you please say it again?")
+        write_reply("Sorry, I couldn't quite catch that. Could you please say it again?", turn)
         return
     if user_input == "__recognition_error__":
-        with open('output.txt', 'w', encoding='utf-8') as f:
-            f.write("I'm having trouble reaching my speech recognition service right now.")
+        write_reply("I'm having trouble reaching my speech recognition service right now.", turn)
         return
 
     history = load_history()
@@ -92,41 +244,29 @@ def process_text_input(user_input: str):
             target=background_summarize_and_save, args=(history.copy(),), daemon=True
         )
         summarize_thread.start()
-    
-    api_context = get_system_prompt() + history
-    payload = {"prompt": user_input, "history": api_context}
-    chat_api_endpoint = f"{GEMINI_API_URL}/api/chat"
 
     try:
-        full_response_text = ""
-        with requests.post(chat_api_endpoint, json=payload, stream=True, timeout=60) as response:
-            response.raise_for_status()
-            for chunk in response.iter_content(chunk_size=None, decode_unicode=True):
-                if chunk:
-                    full_response_text += chunk
-        
-        response_text = full_response_text.strip()
+        response_text = get_response(user_input, history, turn)
         response_to_save = response_text
 
         if response_text.startswith("[intent_open_app]"):
             app_name = response_text.replace("[intent_open_app]", "").strip()
             print(f"Bot (Action): Okay, launching '{app_name}'...")
+            tracing.mark(turn, 'action', 'start')
             launch_app(app_name)
+            tracing.mark(turn, 'action', 'end')
             response_to_save = f"Launched application: {app_name}"
             # No audio response needed for this action, write an empty file
-            with open('output.txt', 'w', encoding='utf-8') as f:
-                f.write('')
+            write_reply('', turn)
 
         elif response_text.startswith("[intent_chitchat]"):
             bot_message = response_text.replace("[intent_chitchat]", "").strip()
             print(f"Bot: {bot_message}")
             response_to_save = bot_message
-            with open('output.txt', 'w', encoding='utf-8') as f:
-                f.write(bot_message)
+            write_reply(bot_message, turn)
         else:
             print(f"Bot (Debug): Unexpected format from model: {response_text}")
-            with open('output.txt', 'w', encoding='utf-8') as f:
-                f.write(response_text) # Still speak the raw response
+            write_reply(response_text, turn) # Still speak the raw response
 
         history.append({"role": "user", "parts": [{"text": user_input}]})
         history.append({"role": "model", "parts": [{"text": response_to_save}]})
@@ -135,22 +275,32 @@ def process_text_input(user_input: str):
 
     except Exception as e:
         print(f"--- ERROR in processing logic: {e} ---")
-        send_ui_command("reset") # Reset UI on failure
+        error_counter.inc()
+        tracing.mark(turn, 'llm', 'end', error=str(e))
+        send_ui_command("reset", turn=turn) # Reset UI on failure
 
 # --- Main Listener Loop ---
 def main():
-    """Listens for transcribed text on a UDP socket and processes it."""
-    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
-        sock.bind(("127.0.0.1", TEXT_LISTEN_PORT))
-        print(f"Logic loop ready. Listening for text on UDP port {TEXT_LISTEN_PORT}.")
-        while True:
-            # Wait here until text is received from the speech script
-            data, _ = sock.recvfrom(4096)
-            user_input = data.decode('utf-8')
-            process_text_input(user_input)
+    """Listens for transcribed text on the message bus and processes it."""
+    text_queue = queue.Queue()
+    metrics.gauge('ketta_intent_pending_transcripts', "Transcripts waiting for the logic loop", fn=text_queue.qsize)
+    bus.ensure_broker()
+    metrics.start()
+    # The callback runs on the bus reader thread, so it only queues; processing happens here.
+    bus.subscribe(bus.TOPIC_STT_TEXT, lambda text, message: text_queue.put((text, message.get('turn'))))
+    bus.subscribe(bus.TOPIC_STT_PARTIAL, handle_partial_text)
+    print(f"Logic loop ready. Listening for text on '{bus.TOPIC_STT_TEXT}'.")
+    while True:
+        # Wait here until text is received from the speech script
+        user_input, turn = text_queue.get()
+        process_text_input(user_input, turn)
 
 if __name__ == '__main__':
     try:
         main()
     except KeyboardInterrupt:
         print("\nLogic loop interrupted by user.")
+        stats = get_cache_stats()
+        print(f"Response cache: {stats['hits']} hits, {stats['misses']} misses ({stats['hit_rate']:.0%}), "
+              f"{stats['speculative_confirmed']} speculative requests confirmed, "
+              f"{stats['seconds_saved']:.1f} s of model time saved.")
@@ -0,0 +1,222 @@
+# ketta.py
+#
+# Runs the whole assistant from one process: the message bus broker, the wakeword
+# listener (which drives VAD/STT), the logic loop, TTS and the orb UI. Blocking
+# work (audio, inference, HTTP, playback) runs on worker threads supervised by an
+# asyncio core; any stage can instead be isolated in its own process.
+#
+#   python ketta.py                      # everything in-process
+#   python ketta.py --no-ui              # headless
+#   python ketta.py --isolate ui,tts     # the orb and TTS as supervised child processes
+
+import time
+_startup_t0 = time.perf_counter()
+
+import os
+import sys
+import signal
+import asyncio
+import argparse
+import threading
+
+import bus
+import metrics
+
+# --- Configuration ---
+STAGES = ('wakeword', 'intent', 'tts', 'ui')
+STAGE_SCRIPTS = {'wakeword': 'tm_model.py', 'intent': 'intent.py', 'tts': 'tts_online.py', 'ui': 'app.py'}
+RESTART_DELAYS = (1, 2, 5, 10) # Seconds before restarting an isolated stage, by consecutive failure
+STABLE_RUN_TIME = 60 # An isolated stage that ran this long before exiting restarts without backoff
+STOP_TIMEOUT = 3 # Seconds an isolated stage gets to exit before it is killed
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# --- Startup Profile ---
+startup = metrics.StartupProfile(_startup_t0)
+
+# --- Stages ---
+# Each loader imports its stage's modules only when that stage runs in this process,
+# and returns the blocking function that runs the stage plus one that stops it.
+def load_wakeword(args):
+    import tm_model
+    tm_model.load_model(args.model, args.labels)
+    return tm_model.main, tm_model.stop_event.set
+
+def load_intent(args):
+    import intent
+    return intent.main, None # Its loop only blocks on a queue; the daemon thread ends with the process
+
+def load_tts(args):
+    import tts_online
+    return tts_online.main, tts_online.shutdown
+
+STAGE_LOADERS = {'wakeword': load_wakeword, 'intent': load_intent, 'tts': load_tts}
+
+# --- Asyncio Core ---
+async def run_in_worker(name, target):
+    """Runs a blocking function on a daemon thread and waits for it without blocking the event loop."""
+    loop = asyncio.get_running_loop()
+    finished = loop.create_future()
+
+    def settle(result, error):
+        if finished.done():
+            return
+        if error is not None:
+            finished.set_exception(error)
+        else:
+            finished.set_result(result)
+
+    def worker():
+        try:
+            result, error = target(), None
+        except Exception as e:
+            result, error = None, e
+        try:
+            loop.call_soon_threadsafe(settle, result, error)
+        except RuntimeError:
+            pass # The core has already shut down
+
+    # Daemon threads rather than an executor: a stage stuck in a device read must not hold up exit.
+    threading.Thread(target=worker, name=name, daemon=True).start()
+    return await finished
+
+async def supervise_thread(stage, target):
+    try:
+        await run_in_worker(stage, target)
+        print(f"Stage '{stage}' exited.")
+    except Exception as e:
+        print(f"Stage '{stage}' failed: {e}")
+
+async def supervise_process(stage, stop, stage_args=()):
+    """Runs an isolated stage as a child process, restarting it with backoff until `stop` is set."""
+    script = os.path.join(REPO_DIR, STAGE_SCRIPTS[stage])
+    failures = 0
+    while not stop.is_set():
+        started = time.monotonic()
+        process = await asyncio.create_subprocess_exec(sys.executable, script, *stage_args, cwd=os.getcwd())
+        print(f"Stage '{stage}' started in process {process.pid}.")
+        exited = asyncio.ensure_future(process.wait())
+        stopping = asyncio.ensure_future(stop.wait())
+        done, _ = await asyncio.wait({exited, stopping}, return_when=asyncio.FIRST_COMPLETED)
+
+        if stopping in done:
+            if process.returncode is None:
+                process.send_signal(signal.SIGINT) # Lets the stage run its own KeyboardInterrupt cleanup
+                try:
+                    await asyncio.wait_for(exited, STOP_TIMEOUT)
+                except asyncio.TimeoutError:
+                    process.kill()
+                    await exited
+            return
+
+        stopping.cancel()
+        failures = 0 if time.monotonic() - started > STABLE_RUN_TIME else failures + 1
+        delay = RESTART_DELAYS[min(failures, len(RESTART_DELAYS)) - 1] if failures else 0
+        print(f"Stage '{stage}' exited with status {process.returncode}; restarting in {delay} s.")
+        try:
+            await asyncio.wait_for(stop.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
+
+class Core:
+    """The asyncio loop that supervises every stage. Runs on whichever thread calls run()."""
+    def __init__(self, threaded_stages, isolated_stages):
+        self.threaded_stages = threaded_stages # stage -> (run, stop)
+        self.isolated_stages = isolated_stages # stage -> command-line arguments for its script
+        self.loop = None
+        self.stop_event = None
+        self.ready = threading.Event()
+
+    async def main(self):
+        self.loop = asyncio.get_running_loop()
+        self.stop_event = asyncio.Event()
+        if threading.current_thread() is threading.main_thread():
+            for signum in (signal.SIGINT, signal.SIGTERM):
+                self.loop.add_signal_handler(signum, self.stop_event.set)
+        self.ready.set()
+
+        thread_tasks = [asyncio.ensure_future(supervise_thread(stage, run))
+                        for stage, (run, _) in self.threaded_stages.items()]
+        process_tasks = [asyncio.ensure_future(supervise_process(stage, self.stop_event, stage_args))
+                         for stage, stage_args in self.isolated_stages.items()]
+        startup.record('stages started')
+        startup.report()
+
+        await self.stop_event.wait()
+        print("\nShutting down...")
+        for stage, (_, stop) in self.threaded_stages.items():
+            if stop is not None:
+                stop()
+        await asyncio.gather(*process_tasks)
+        for task in thread_tasks:
+            task.cancel()
+
+    def run(self):
+        asyncio.run(self.main())
+
+    def request_stop(self):
+        """Thread-safe: asks the core to stop every stage and return from run()."""
+        self.ready.wait()
+        try:
+            self.loop.call_soon_threadsafe(self.stop_event.set)
+        except RuntimeError:
+            pass # Already stopped
+
+def parse_stage_list(value):
+    stages = [stage.strip() for stage in value.split(',') if stage.strip()]
+    unknown = [stage for stage in stages if stage not in STAGES]
+    if unknown:
+        raise argparse.ArgumentTypeError(f"unknown stage(s) {', '.join(unknown)}; choose from {', '.join(STAGES)}")
+    return stages
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the Ketta assistant in a single process.")
+    parser.add_argument('--stages', type=parse_stage_list, default=list(STAGES),
+                        help=f"comma-separated stages to run (default: {','.join(STAGES)})")
+    parser.add_argument('--isolate', type=parse_stage_list, default=[],
+                        help="comma-separated stages to run in their own supervised process")
+    parser.add_argument('--no-ui', action='store_true', help="run without the orb")
+    parser.add_argument('--model', default='model.tflite', help="wakeword TFLite model")
+    parser.add_argument('--labels', default='labels.txt', help="wakeword model labels")
+    args = parser.parse_args(argv)
+
+    stages = [stage for stage in args.stages if not (stage == 'ui' and args.no_ui)]
+    isolated = [stage for stage in stages if stage in args.isolate]
+    in_process = [stage for stage in stages if stage not in isolated]
+    startup.record('imports')
+
+    # Host the broker before anything else, so isolated stages connect to it instead of racing for it.
+    bus.ensure_broker()
+    metrics.start('ketta') # Before the stages, so they all report on this process's endpoint
+    startup.record('message bus')
+
+    threaded_stages = {}
+    for stage in in_process:
+        if stage == 'ui':
+            continue # Qt must own the main thread; started below
+        try:
+            threaded_stages[stage] = STAGE_LOADERS[stage](args)
+        except Exception as e:
+            print(f"Could not start stage '{stage}': {e}")
+            return 1
+        startup.record(f"{stage} load")
+
+    # Isolated stages get the same settings they would have had in-process.
+    stage_args = {'wakeword': ['--model', os.path.abspath(args.model), '--labels', os.path.abspath(args.labels)]}
+    core = Core(threaded_stages, {stage: stage_args.get(stage, []) for stage in isolated})
+    if 'ui' not in in_process:
+        core.run()
+        return 0
+
+    import app
+    startup.record('ui imports')
+    core_thread = threading.Thread(target=core.run, name='core', daemon=True)
+    core_thread.start()
+    try:
+        status = app.run_ui()
+    finally:
+        core.request_stop()
+        core_thread.join(timeout=STOP_TIMEOUT + 1)
+    return status
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,271 @@
+# metrics.py
+#
+# A small in-process metrics registry. Components register counters, gauges and
+# timers; start() exposes them on a local Prometheus-style scrape endpoint
+# (http://127.0.0.1:<port>/metrics, or /metrics.json) and dumps them to a JSON
+# file every few seconds. Gauges backed by a callback are only evaluated when
+# the metrics are read, so they cost nothing on the hot path.
+
+import os
+import sys
+import json
+import time
+import bisect
+import tempfile
+import threading
+import http.server
+
+# --- Configuration ---
+METRICS_DIR = os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir()
+DUMP_INTERVAL = 10 # Seconds between JSON dumps
+# One scrape port per component, so they can run side by side; ketta.py hosts them all in one.
+COMPONENT_PORTS = {'ketta': 9460, 'tm_model': 9461, 'intent': 9462, 'tts_online': 9463, 'app': 9464, 'vad': 9465,
+                   'bus': 9466}
+TIMER_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10) # Seconds
+
+class Counter:
+    """A value that only goes up. With `fn`, the value is read from fn() instead."""
+    kind = 'counter'
+
+    def __init__(self, name, help_text, fn=None):
+        self.name = name
+        self.help = help_text
+        self.fn = fn
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def get(self):
+        return self.fn() if self.fn is not None else self.value
+
+class Gauge:
+    """A value that goes up and down. With `fn`, the value is read from fn() instead."""
+    kind = 'gauge'
+
+    def __init__(self, name, help_text, fn=None):
+        self.name = name
+        self.help = help_text
+        self.fn = fn
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def get(self):
+        return self.fn() if self.fn is not None else self.value
+
+class Timer:
+    """A histogram of durations in seconds. Use observe(), or `with timer.time():`."""
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, buckets=TIMER_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1) # The last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, seconds):
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self.lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += seconds
+            if seconds > self.max:
+                self.max = seconds
+
+    def time(self):
+        return _TimerContext(self)
+
+    def get(self):
+        with self.lock:
+            return {'count': self.count, 'sum': self.sum, 'max': self.max,
+                    'mean': self.sum / self.count if self.count else 0.0, 'buckets': list(self.counts)}
+
+class _TimerContext:
+    def __init__(self, timer):
+        self.timer = timer
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.timer.observe(time.perf_counter() - self.start)
+        return False
+
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {} # name -> metric, in registration order
+
+    def register(self, cls, name, help_text, **kwargs):
+        """Returns the metric called `name`, creating it on first use."""
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = cls(name, help_text, **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError(f"Metric '{name}' is already registered as a {metric.kind}")
+            return metric
+
+    def collect(self):
+        """Returns [(metric, value)], skipping callbacks that fail (e.g. a file that does not exist yet)."""
+        with self.lock:
+            metrics = list(self.metrics.values())
+        values = []
+        for metric in metrics:
+            try:
+                values.append((metric, metric.get()))
+            except Exception:
+                continue
+        return values
+
+    def render_prometheus(self):
+        lines = []
+        for metric, value in self.collect():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            if isinstance(metric, Timer):
+                cumulative = 0
+                for bound, count in zip(metric.buckets + (float('inf'),), value['buckets']):
+                    cumulative += count
+                    label = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append(f'{metric.name}_bucket{{le="{label}"}} {cumulative}')
+                lines.append(f"{metric.name}_sum {value['sum']}")
+                lines.append(f"{metric.name}_count {value['count']}")
+            else:
+                lines.append(f"{metric.name} {float(value)}")
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        return {metric.name: value for metric, value in self.collect()}
+
+registry = Registry()
+
+def counter(name, help_text, fn=None):
+    return registry.register(Counter, name, help_text, fn=fn)
+
+def gauge(name, help_text, fn=None):
+    return registry.register(Gauge, name, help_text, fn=fn)
+
+def timer(name, help_text, buckets=TIMER_BUCKETS):
+    return registry.register(Timer, name, help_text, buckets=buckets)
+
+# --- Summaries ---
+# Shared by everything that reports latencies or startup costs outside the registry
+# (bus stats, tracing.py, benchmark.py, the startup profiles of ketta.py and app.py).
+SUMMARY_PERCENTILES = (0.5, 0.9, 0.99)
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+def summarize(values):
+    """Returns the count, mean, p50/p90/p99 and max of values, or just a zero count."""
+    values = sorted(values)
+    if not values:
+        return {'count': 0}
+    summary = {'count': len(values), 'mean': sum(values) / len(values)}
+    for fraction in SUMMARY_PERCENTILES:
+        summary[f"p{fraction * 100:.0f}"] = percentile(values, fraction)
+    summary['max'] = values[-1]
+    return summary
+
+def read_rss_kb():
+    """Returns (current RSS, peak RSS) of this process in kB, or zeros where /proc is unavailable."""
+    values = {}
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith(('VmRSS:', 'VmHWM:')):
+                    key, value = line.split(':', 1)
+                    values[key] = int(value.split()[0])
+    except OSError:
+        pass
+    return values.get('VmRSS', 0), values.get('VmHWM', 0)
+
+class StartupProfile:
+    """Time and RSS after each startup phase, measured from `t0` (a perf_counter() taken before the imports)."""
+    def __init__(self, t0):
+        self.t0 = t0
+        self.phases = [] # (name, perf_counter() at its end, duration in ms, RSS in MB)
+
+    def record(self, name):
+        """Records the time since the previous phase (or t0) under `name`, with the RSS after it."""
+        now = time.perf_counter()
+        previous = self.phases[-1][1] if self.phases else self.t0
+        self.phases.append((name, now, (now - previous) * 1000, read_rss_kb()[0] / 1024))
+
+    def report(self):
+        print(f"\n{'startup phase':<28}{'ms':>9}{'RSS MB':>9}")
+        for name, _, duration_ms, rss_mb in self.phases:
+            print(f"{name:<28}{duration_ms:>9.0f}{rss_mb:>9.1f}")
+        total_ms = (self.phases[-1][1] - self.t0) * 1000 if self.phases else 0.0
+        print(f"{'total':<28}{total_ms:>9.0f}\n")
+
+# --- Exposure ---
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == '/metrics':
+            body, content_type = registry.render_prometheus(), 'text/plain; version=0.0.4'
+        elif self.path == '/metrics.json':
+            body, content_type = json.dumps(registry.snapshot()), 'application/json'
+        else:
+            self.send_error(404)
+            return
+        payload = body.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass # Scrapes every few seconds would flood the console
+
+def dump_loop(path, interval):
+    while True:
+        time.sleep(interval)
+        snapshot = registry.snapshot()
+        snapshot['timestamp'] = time.time()
+        try:
+            temp_path = f"{path}.tmp"
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(snapshot, f)
+            os.replace(temp_path, path) # Readers never see a half-written dump
+        except OSError as e:
+            print(f"Could not write metrics dump: {e}")
+
+_started = None
+_start_lock = threading.Lock()
+
+def start(component=None, port=None):
+    """
+    Starts the scrape endpoint and the periodic JSON dump for this process, on
+    daemon threads. Safe to call more than once; only the first call counts, so
+    ketta.py can start it before the components it hosts try to. Returns the port.
+    """
+    global _started
+    with _start_lock:
+        if _started is not None:
+            return _started
+        component = component or os.path.splitext(os.path.basename(sys.argv[0] or 'python'))[0]
+        port = COMPONENT_PORTS.get(component, 0) if port is None else port
+        try:
+            server = http.server.ThreadingHTTPServer(('127.0.0.1', port), MetricsHandler)
+        except OSError:
+            server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), MetricsHandler) # Port taken: any free one
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+
+        dump_path = os.path.join(METRICS_DIR, f"ketta-metrics-{component}.json")
+        threading.Thread(target=dump_loop, args=(dump_path, DUMP_INTERVAL), name='metrics-dump', daemon=True).start()
+        _started = server.server_address[1]
+        print(f"Metrics for '{component}' on http://127.0.0.1:{_started}/metrics (dumped to {dump_path})")
+        return _started
@@ -1,9 +1,24 @@
 import os
-import subprocess
 import configparser
 import shutil
-import difflib
+import json
+import threading
+import time
 import control
+from app_launcher import AppLauncher, parse_exec
+from app_matcher import AppMatcher, UsageStore, MATCH_CUTOFF, normalize
+
+try:
+    import inotify_simple # Optional: enables incremental index updates
+except ImportError:
+    inotify_simple = None
+
+# --- Configuration ---
+SNAP_BASE_DIR = '/snap/'
+INDEX_CACHE_PATH = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+                                'ketta', 'app_index.json')
+INDEX_VERSION = 4
+INDEX_MAX_AGE = 2.0 # Seconds an index is trusted without inotify before it is re-validated
 
 def get_app_data_from_desktop_file(filepath):
     config = configparser.ConfigParser(interpolation=None)
@@ -22,23 +37,36 @@ def get_app_data_from_desktop_file(filepath):
         type_ = desktop_entry.get('Type')
 
         if app_name and exec_command and type_ == 'Application' and not no_display and not hidden:
-            clean_exec_command = exec_command.split('%')[0].strip().split()[0].strip()
-
-            if not clean_exec_command:
+            try:
+                clean_exec_command = parse_exec(exec_command)[0]
+            except ValueError:
                 return None
 
             resolved_path = clean_exec_command if os.path.isabs(clean_exec_command) else shutil.which(clean_exec_command)
 
             if resolved_path and os.path.exists(resolved_path):
+                # configparser lowercases keys, so 'Name[de]' is stored as 'name[de]'.
+                localized_names = [v for k, v in desktop_entry.items() if k.startswith('name[')]
+                localized_generic_names = [v for k, v in desktop_entry.items() if k.startswith('genericname[')]
+                keywords = [k for k in desktop_entry.get('Keywords', '').split(';') if k.strip()]
                 return {
                     'name': app_name,
                     'exec_path': resolved_path,
-                    'terminal': terminal
+                    'terminal': terminal,
+                    'generic_name': desktop_entry.get('GenericName', ''),
+                    'localized_names': localized_names,
+                    'localized_generic_names': localized_generic_names,
+                    'keywords': keywords,
+                    'exec_name': os.path.basename(clean_exec_command),
+                    'exec': exec_command,
+                    'icon': desktop_entry.get('Icon', ''),
+                    'working_dir': desktop_entry.get('Path', ''),
+                    'desktop_file': filepath,
                 }
     return None
 
-def get_installed_applications():
-    applications = {}
+def get_search_paths():
+    """Returns every applications directory to index, including each snap's."""
     search_paths = [
         '/usr/share/applications/',
         '/usr/local/share/applications/',
@@ -46,44 +74,321 @@ def get_installed_applications():
         '/var/lib/snapd/desktop/applications/',
     ]
 
-    snap_base_dir = '/snap/'
-    if os.path.isdir(snap_base_dir):
-        for entry in os.listdir(snap_base_dir):
-            snap_app_path = os.path.join(snap_base_dir, entry, "current", "usr", "share", "applications")
+    if os.path.isdir(SNAP_BASE_DIR):
+        for entry in sorted(os.listdir(SNAP_BASE_DIR)):
+            snap_app_path = os.path.join(SNAP_BASE_DIR, entry, "current", "usr", "share", "applications")
             if os.path.isdir(snap_app_path):
                 search_paths.append(snap_app_path)
+    return search_paths
+
+def _mtime_ns(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+class ApplicationIndex:
+    """
+    A persistent index of installed applications.
+
+    Directories and .desktop files are validated by mtime, so only files that
+    changed since the last run (or the last refresh) are parsed again. When
+    inotify_simple is installed, a watcher thread marks changed directories as
+    dirty and lookups skip validation entirely until something changes. Search
+    paths that cannot be watched (most often ~/.local/share/applications on a
+    fresh account, before it exists) are checked every INDEX_MAX_AGE instead,
+    and watched as soon as they appear. Directories are also keyed on the path
+    they resolve to, so a snap refresh, which only flips /snap/<name>/current
+    to the new revision, re-indexes that snap.
+    """
+    def __init__(self, cache_path=INDEX_CACHE_PATH):
+        self.cache_path = cache_path
+        self.lock = threading.Lock()
+        self.snap_mtime = None
+        self.search_paths = []
+        self.dirs = {}  # directory -> {'mtime': ns, 'target': resolved path, 'files': [filename, ...]}
+        self.files = {} # .desktop path -> {'mtime': ns, 'app': dict or None}
+        self.applications = {}
+        self.generation = 0 # Bumped whenever self.applications is rebuilt
+        self.last_validated = 0.0
+        self.dirty_dirs = set()
+        self.watcher = None
+        self.changed = False
+        self.load()
+
+    def load(self):
+        """Loads the index saved by a previous run, if it is still compatible."""
+        try:
+            with open(self.cache_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if data.get('version') != INDEX_VERSION:
+            return
+        self.snap_mtime = data.get('snap_mtime')
+        self.search_paths = data.get('search_paths', [])
+        self.dirs = data.get('dirs', {})
+        self.files = data.get('files', {})
+        self.rebuild_applications()
+
+    def save(self):
+        """Writes the index to disk atomically, if anything changed."""
+        if not self.changed:
+            return
+        data = {
+            'version': INDEX_VERSION,
+            'snap_mtime': self.snap_mtime,
+            'search_paths': self.search_paths,
+            'dirs': self.dirs,
+            'files': self.files,
+        }
+        try:
+            os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+            tmp_path = f"{self.cache_path}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f)
+            os.replace(tmp_path, self.cache_path)
+            self.changed = False
+        except OSError as e:
+            print(f"Could not save application index: {e}")
+
+    def rebuild_applications(self):
+        applications = {}
+        for base_dir in self.search_paths:
+            for filename in self.dirs.get(base_dir, {}).get('files', []):
+                entry = self.files.get(os.path.join(base_dir, filename))
+                if entry and entry['app']:
+                    applications[entry['app']['name'].lower()] = entry['app']
+        self.applications = applications
+        self.generation += 1
+
+    def refresh_search_paths(self):
+        """Re-lists the snap directory only when it changed. Returns the newly added directories."""
+        snap_mtime = _mtime_ns(SNAP_BASE_DIR)
+        if snap_mtime == self.snap_mtime and self.search_paths:
+            return set()
+        search_paths = get_search_paths()
+        added = set(search_paths) - set(self.search_paths)
+        for stale_dir in set(self.search_paths) - set(search_paths):
+            self.forget_dir(stale_dir)
+        self.search_paths = search_paths
+        self.snap_mtime = snap_mtime
+        self.changed = True
+        if self.watcher:
+            self.watcher.watch(self.search_paths)
+        return added
+
+    def forget_dir(self, base_dir):
+        for filename in self.dirs.pop(base_dir, {}).get('files', []):
+            self.files.pop(os.path.join(base_dir, filename), None)
 
-    for base_dir in search_paths:
-        if not os.path.isdir(base_dir):
-            continue
+    def refresh_dir(self, base_dir):
+        """Brings one directory up to date, re-parsing only the files whose mtime changed."""
+        dir_mtime = _mtime_ns(base_dir)
+        if dir_mtime is None:
+            if base_dir in self.dirs:
+                self.forget_dir(base_dir)
+                self.changed = True
+            return
 
+        target = os.path.realpath(base_dir)
+        known = self.dirs.get(base_dir)
+        if known is not None and known['target'] != target:
+            # A new snap revision: nothing parsed from the old one holds, even where the mtimes match.
+            self.forget_dir(base_dir)
+            known = None
+        if known is None or known['mtime'] != dir_mtime:
+            # Files were added, removed or renamed: re-list the directory.
+            try:
+                filenames = sorted(f for f in os.listdir(base_dir) if f.endswith(".desktop"))
+            except OSError:
+                return
+            for filename in set(known['files'] if known else []) - set(filenames):
+                self.files.pop(os.path.join(base_dir, filename), None)
+            self.dirs[base_dir] = {'mtime': dir_mtime, 'target': target, 'files': filenames}
+            self.changed = True
+
+        for filename in self.dirs[base_dir]['files']:
+            filepath = os.path.join(base_dir, filename)
+            file_mtime = _mtime_ns(filepath)
+            entry = self.files.get(filepath)
+            if entry is not None and entry['mtime'] == file_mtime:
+                continue
+            try:
+                app_data = get_app_data_from_desktop_file(filepath)
+            except Exception:
+                app_data = None
+            self.files[filepath] = {'mtime': file_mtime, 'app': app_data}
+            self.changed = True
+
+    def refresh(self, force=False):
+        """Validates the index against the filesystem when it may be stale."""
+        with self.lock:
+            now = time.monotonic()
+            if self.watcher and self.watcher.alive:
+                dirty = self.watcher.take_dirty()
+                unwatched = set()
+                if force or now - self.last_validated >= INDEX_MAX_AGE:
+                    unwatched = self.watcher.unwatched()
+                    if unwatched:
+                        # Watch before scanning, so nothing added in between is missed.
+                        self.watcher.watch(self.search_paths)
+                if not dirty and not unwatched and not force and self.search_paths:
+                    return
+                added = self.refresh_search_paths()
+                for base_dir in (self.search_paths if force else dirty | added | unwatched):
+                    if base_dir in self.search_paths:
+                        self.refresh_dir(base_dir)
+            else:
+                if not force and self.search_paths and now - self.last_validated < INDEX_MAX_AGE:
+                    return
+                self.refresh_search_paths()
+                for base_dir in self.search_paths:
+                    self.refresh_dir(base_dir)
+            self.last_validated = now
+            if self.changed:
+                self.rebuild_applications()
+                self.save()
+
+    def start_watcher(self):
+        """Starts inotify-driven updates. Returns False if inotify_simple is not installed."""
+        if inotify_simple is None:
+            return False
+        with self.lock:
+            if self.watcher is None:
+                self.watcher = DirectoryWatcher()
+            self.watcher.watch(self.search_paths or get_search_paths())
+        # Everything that changed while nobody was watching still needs one full validation.
+        self.refresh(force=True)
+        return True
+
+class DirectoryWatcher:
+    """Collects the applications directories that changed, using inotify."""
+    def __init__(self):
+        flags = inotify_simple.flags
+        self.flags = (flags.CREATE | flags.DELETE | flags.MODIFY | flags.CLOSE_WRITE |
+                      flags.MOVED_FROM | flags.MOVED_TO | flags.ATTRIB | flags.DELETE_SELF | flags.MOVE_SELF)
+        self.inotify = inotify_simple.INotify()
+        self.lock = threading.Lock()
+        self.watches = {} # watch descriptor -> directory
+        self.targets = {} # directory -> (watch descriptor, the path it resolved to when it was watched)
+        self.wanted = [] # The search paths that should be watched, whether or not they exist yet
+        self.dirty = set()
+        self.alive = True
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def watch(self, directories):
+        """Watches every directory that exists; the rest are reported by unwatched() until they do."""
+        with self.lock:
+            self.wanted = list(directories)
+            for directory in [SNAP_BASE_DIR] + list(directories):
+                if not os.path.isdir(directory):
+                    continue
+                target = os.path.realpath(directory)
+                watched = self.targets.get(directory)
+                if watched is not None:
+                    if watched[1] == target:
+                        continue
+                    # inotify watches the directory a symlink pointed to, and an old
+                    # snap revision never changes again: move the watch to the new one.
+                    self.watches.pop(watched[0], None)
+                    del self.targets[directory]
+                    try:
+                        self.inotify.rm_watch(watched[0])
+                    except OSError:
+                        pass
+                try:
+                    wd = self.inotify.add_watch(directory, self.flags)
+                except OSError as e:
+                    print(f"Cannot watch '{directory}': {e}")
+                    continue
+                self.watches[wd] = directory
+                self.targets[directory] = (wd, target)
+
+    def unwatched(self):
+        """The wanted directories with no watch, or whose watch is on what they used to resolve to."""
+        with self.lock:
+            return {directory for directory in self.wanted
+                    if directory not in self.targets or self.targets[directory][1] != os.path.realpath(directory)}
+
+    def take_dirty(self):
+        with self.lock:
+            dirty, self.dirty = self.dirty, set()
+            return dirty
+
+    def run(self):
         try:
-            for filename in os.listdir(base_dir):
-                if filename.endswith(".desktop"):
-                    filepath = os.path.join(base_dir, filename)
-                    app_data = get_app_data_from_desktop_file(filepath)
-                    if app_data:
-                        applications[app_data['name'].lower()] = app_data
-        except Exception:
-            continue
+            while True:
+                for event in self.inotify.read():
+                    with self.lock:
+                        if event.mask & inotify_simple.flags.IGNORED:
+                            # The directory was deleted or moved and its watch is gone; it is
+                            # unwatched() again, so it is polled until it is recreated.
+                            directory = self.watches.pop(event.wd, None)
+                            if directory is not None and self.targets.get(directory, (None,))[0] == event.wd:
+                                del self.targets[directory]
+                        else:
+                            directory = self.watches.get(event.wd)
+                        if directory is not None:
+                            self.dirty.add(directory)
+        except Exception as e:
+            print(f"Application index watcher stopped: {e}")
+            self.alive = False
+
+_app_index = None
+_app_index_lock = threading.Lock()
+
+def get_app_index():
+    """Returns the shared application index, loading it from disk on first use."""
+    global _app_index
+    with _app_index_lock:
+        if _app_index is None:
+            _app_index = ApplicationIndex()
+            _app_index.start_watcher()
+        return _app_index
+
+def get_installed_applications():
+    index = get_app_index()
+    index.refresh()
+    return index.applications
+
+_matcher = None
+_matcher_generation = None
+_usage_store = None
+launcher = AppLauncher()
 
-    return applications
+def get_app_matcher():
+    """Returns a fuzzy matcher over the current index, rebuilt only when the index changed."""
+    global _matcher, _matcher_generation, _usage_store
+    index = get_app_index()
+    index.refresh()
+    with _app_index_lock:
+        if _usage_store is None:
+            _usage_store = UsageStore()
+        if _matcher is None or _matcher_generation != index.generation:
+            _matcher = AppMatcher(index.applications, _usage_store)
+            _matcher_generation = index.generation
+        return _matcher
 
+def find_applications(app_name, k=5):
+    """Returns up to k (app info, score) candidates for a spoken app name, best first."""
+    # The matcher carries the catalogue it was built from, so its keys always resolve,
+    # even if the index was refreshed in between.
+    matcher = get_app_matcher()
+    return [(matcher.applications[app_key], score) for app_key, score in matcher.match(app_name, k)]
 
 def launch_application_by_name(app_name):
     apps = get_installed_applications()
-    app_names = list(apps.keys())
 
     # First try exact match
     app_info = apps.get(app_name.lower())
 
-    # If no exact match, try close fuzzy match
+    # If no exact match, try the ranked fuzzy matcher
     if not app_info:
-        close_matches = difflib.get_close_matches(app_name.lower(), app_names, n=1, cutoff=0.75)
-        if close_matches:
-            matched_name = close_matches[0]
-            app_info = apps[matched_name]
-            print(f"Matched input '{app_name}' to '{app_info['name']}'")
+        candidates = find_applications(app_name)
+        if candidates and candidates[0][1] >= MATCH_CUTOFF:
+            app_info, score = candidates[0]
+            print(f"Matched input '{app_name}' to '{app_info['name']}' (score {score:.2f})")
             control.send_ui_command('hide')
 
     if not app_info:
@@ -91,19 +396,16 @@ def launch_application_by_name(app_name):
         return False
 
     try:
-        if app_info['terminal']:
-            subprocess.Popen(['x-terminal-emulator', '-e', app_info['exec_path']])
-        else:
-            subprocess.Popen([app_info['exec_path']])
+        launcher.launch(app_info)
         print(f"Launched '{app_info['name']}'")
+        get_app_matcher().usage.record(normalize(app_name), app_info['name'].lower())
         return True
     except Exception as e:
         print(f"Failed to launch '{app_info['name']}': {e}")
         return False
+
 # Example usage
 if __name__ == "__main__":
     while 1:
         launch_application_by_name(input('Name : '))  # Change app name here
 
-
-print(get_installed_applications())
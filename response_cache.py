@@ -0,0 +1,148 @@
+# response_cache.py
+
+import re
+import json
+import time
+import hashlib
+import threading
+import collections
+import metrics
+
+# --- Configuration ---
+MAX_ENTRIES = 128
+OPEN_APP_TTL = 24 * 3600 # Seconds. "open terminal" means the same thing all day
+CHITCHAT_TTL = 10 * 60   # Seconds. Small talk goes stale quickly
+CONTEXT_MESSAGES = 4     # History messages an utterance that refers back to the conversation is keyed on
+# Words that make an utterance depend on what was said before: pronouns ("tell me more about it"),
+# short replies ("yes", "no thanks", "sure") and follow-ups ("the second one", "what about tomorrow").
+CONTEXT_WORDS = frozenset((
+    'it', 'its', 'that', 'this', 'these', 'those', 'they', 'them', 'their', 'he', 'him', 'his',
+    'she', 'her', 'there', 'again', 'more', 'else', 'another', 'previous', 'last', 'same', 'why',
+    'yes', 'yeah', 'yep', 'no', 'nope', 'nah', 'sure', 'ok', 'okay',
+    'one', 'first', 'second', 'third', 'next', 'other', 'about', 'instead', 'too',
+))
+_NON_WORD = re.compile(r"[^\w]+")
+_DIGIT = re.compile(r"\d")
+
+def normalize(utterance):
+    """Lowercases and strips punctuation, so "What's up?" and "what's up" share an entry."""
+    return ' '.join(_NON_WORD.sub(' ', utterance.lower()).split())
+
+def refers_back(normalized):
+    """True if the utterance only makes sense given the conversation so far."""
+    return bool(CONTEXT_WORDS.intersection(normalized.split()))
+
+def context_digest(normalized, history):
+    """Empty for self-contained utterances; otherwise a digest of the last few history messages."""
+    if not refers_back(normalized):
+        return ''
+    recent = json.dumps(history[-CONTEXT_MESSAGES:], sort_keys=True)
+    return hashlib.sha1(recent.encode('utf-8')).hexdigest()[:16]
+
+def make_key(utterance, history):
+    normalized = normalize(utterance)
+    return normalized, context_digest(normalized, history)
+
+def ttl_for(response_text):
+    """How long a model response may be reused, or None if it must not be cached."""
+    if response_text.startswith('[intent_open_app]'):
+        return OPEN_APP_TTL
+    if response_text.startswith('[intent_chitchat]'):
+        # Anything with a number in it (times, dates, scores, prices) is likely to be stale next time.
+        return None if _DIGIT.search(response_text) else CHITCHAT_TTL
+    return None # Unexpected formats are spoken as-is, but never replayed
+
+class ResponseCache:
+    """
+    An LRU cache of model responses, each entry with its own expiry time.
+    Self-contained utterances ("hello", "open terminal") share one entry across
+    the whole conversation; ones that refer back to it are also keyed on its recent history.
+    """
+    def __init__(self, max_entries=MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict() # key -> (response, expires at, seconds the request took)
+        self.hit_counter = metrics.counter('ketta_response_cache_hits_total', "Turns answered from the response cache")
+        self.miss_counter = metrics.counter('ketta_response_cache_misses_total', "Turns that needed a model request")
+        self.saved_counter = metrics.counter('ketta_llm_seconds_saved_total',
+                                             "Model request time avoided by cache hits and speculative requests")
+        metrics.gauge('ketta_response_cache_entries', "Entries in the response cache", fn=lambda: len(self.entries))
+
+    def lookup(self, key, count=True):
+        """Returns (response, seconds the original request took), or None. count=False leaves the stats alone."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] <= time.monotonic():
+                del self.entries[key]
+                entry = None
+            if entry is not None:
+                self.entries.move_to_end(key)
+        if count:
+            if entry is None:
+                self.miss_counter.inc()
+            else:
+                self.hit_counter.inc()
+                self.saved_counter.inc(entry[2])
+        return (entry[0], entry[2]) if entry is not None else None
+
+    def store(self, key, response, request_seconds):
+        """Caches a response if its intent allows it. Returns True if it was cached."""
+        ttl = ttl_for(response)
+        if ttl is None:
+            return False
+        with self.lock:
+            self.entries[key] = (response, time.monotonic() + ttl, request_seconds)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return True
+
+    def get_stats(self):
+        hits, misses = self.hit_counter.get(), self.miss_counter.get()
+        return {'entries': len(self.entries), 'hits': hits, 'misses': misses,
+                'hit_rate': hits / (hits + misses) if hits + misses else 0.0,
+                'seconds_saved': self.saved_counter.get()}
+
+def replay_session(session):
+    """
+    Replays (utterance, model response) turns through a fresh cache, growing the
+    history as intent.py does. Returns the utterances that were answered from the cache.
+    """
+    cache, history, hits = ResponseCache(), [], []
+    for utterance, response in session:
+        key = make_key(utterance, history)
+        cached = cache.lookup(key, count=False)
+        if cached is not None:
+            hits.append(utterance)
+            response = cached[0]
+        else:
+            cache.store(key, response, 1.0)
+        history.append({"role": "user", "parts": [{"text": utterance}]})
+        history.append({"role": "model", "parts": [{"text": response}]})
+    return hits
+
+# Self-check: python response_cache.py
+if __name__ == "__main__":
+    session = [
+        ("hello", "[intent_chitchat] Hi there!"),
+        ("open firefox", "[intent_open_app] Firefox"),
+        ("Hello!", "[intent_chitchat] Hi there!"),
+        ("open my browser", "[intent_open_app] Firefox"),
+        ("thanks", "[intent_chitchat] You're welcome."),
+        ("hello", "[intent_chitchat] Hi there!"),
+        ("open my browser", "[intent_open_app] Firefox"),
+        ("open terminal", "[intent_open_app] GNOME Terminal"),
+        ("thanks", "[intent_chitchat] You're welcome."),
+        ("open terminal", "[intent_open_app] GNOME Terminal"),
+    ]
+    hits = replay_session(session)
+    expected = ["Hello!", "hello", "open my browser", "thanks", "open terminal"]
+    assert hits == expected, f"repeated turns should hit: got {hits}, expected {expected}"
+
+    # The same short reply to different questions must not share an answer.
+    timer = [("shall I set a timer", "[intent_chitchat] Shall I set a timer?"), ("yes", "[intent_chitchat] Timer set.")]
+    joke = [("tell me a joke", "[intent_chitchat] Want to hear a joke?"), ("yes", "[intent_chitchat] Why did the...")]
+    assert replay_session(timer + joke) == []
+    for reply in ("yes", "no thanks", "sure", "what about tomorrow", "the second one", "tell me more about it"):
+        assert make_key(reply, [{"text": "a"}]) != make_key(reply, [{"text": "b"}]), reply
+    print(f"Response cache self-check passed: {len(hits)} of {len(session)} turns answered from the cache.")
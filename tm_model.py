@@ -1,12 +1,14 @@
 import numpy as np
-import sounddevice as sd
 # import soundfile as sf # Not used in this version for live input
-import tensorflow as tf # Or tflite_runtime.interpreter as tf
 import time
+import argparse
 import vad # Assuming vad.py contains a main() function
 import threading
 import queue
 import control
+import bus
+import tracing
+import metrics
 
 # --- Configuration ---
 MODEL_PATH = 'model.tflite'  # Replace with the path to your TFLite model
@@ -20,54 +22,79 @@ CONFIDENCE_THRESHOLD = 0.7 # Adjust as needed for your wake word detection
 audio_queue = queue.Queue()
 stop_event = threading.Event() # To signal the recording thread to stop
 
-# --- Load Model ---
-try:
-    interpreter = tf.lite.Interpreter(model_path=MODEL_PATH)
-    interpreter.allocate_tensors()
-except Exception as e:
-    print(f"Error loading TFLite model: {e}")
-    print("Make sure your model path is correct.")
-    exit()
-
-# Get input and output tensor details
-input_details = interpreter.get_input_details()
-output_details = interpreter.get_output_details()
-
-input_shape = input_details[0]['shape']
-input_dtype = input_details[0]['dtype']
-
-print(f"Model Input Shape: {input_shape}")
-print(f"Model Input Dtype: {input_dtype}")
-
-# --- Load Labels ---
-try:
-    with open(LABELS_PATH, 'r') as f:
-        labels = [line.strip() for line in f.readlines()]
-    print(f"Loaded Labels: {labels}")
-except FileNotFoundError:
-    print(f"Error: labels.txt not found at {LABELS_PATH}. Please provide the correct path.")
-    exit()
-except Exception as e:
-    print(f"Error loading labels: {e}")
-    exit()
-
-# Ensure the input shape matches expectations
-# Note: Teachable Machine audio models often expect a specific number of samples,
-# which might not directly be CHUNK_SIZE if they do internal spectrogram conversion.
-# For raw audio input like this script, CHUNK_SIZE should match model's expected raw audio length.
-if len(input_shape) > 1 and input_shape[1] != CHUNK_SIZE:
-    print(f"Warning: Model expects input length {input_shape[1]}, but CHUNK_SIZE is {CHUNK_SIZE}.")
-    print("This might indicate an issue with your model or expected input preprocessing.")
-    print("Ensure your Teachable Machine model was trained with 1-second raw audio samples if CHUNK_SIZE reflects that.")
-    # Consider adjusting CHUNK_SIZE or your model's input layer.
+# --- Metrics ---
+metrics.gauge('ketta_wakeword_audio_queue_depth', "Audio chunks waiting for wakeword inference", fn=audio_queue.qsize)
+input_status_counter = metrics.counter('ketta_wakeword_input_status_total', "Audio callbacks reporting an overflow or other input status")
+invoke_timer = metrics.timer('ketta_wakeword_invoke_seconds', "Duration of each wakeword model invocation")
+detection_counter = metrics.counter('ketta_wakeword_detections_total', "Wakeword detections")
+
+# --- Model State (filled in by load_model) ---
+interpreter = None
+input_details = output_details = None
+input_shape = input_dtype = None
+labels = []
+
+def load_model(model_path=MODEL_PATH, labels_path=LABELS_PATH):
+    """Loads the TFLite model and its labels. Raises if either cannot be loaded."""
+    global interpreter, input_details, output_details, input_shape, input_dtype, labels
+    # The standalone TFLite runtime is a fraction of TensorFlow's import time and memory.
+    try:
+        from tflite_runtime.interpreter import Interpreter
+    except ImportError:
+        import tensorflow as tf
+        Interpreter = tf.lite.Interpreter
+
+    # --- Load Model ---
+    try:
+        interpreter = Interpreter(model_path=model_path)
+        interpreter.allocate_tensors()
+    except Exception as e:
+        print(f"Error loading TFLite model: {e}")
+        print("Make sure your model path is correct.")
+        raise
+
+    # Get input and output tensor details
+    input_details = interpreter.get_input_details()
+    output_details = interpreter.get_output_details()
+
+    input_shape = input_details[0]['shape']
+    input_dtype = input_details[0]['dtype']
+
+    print(f"Model Input Shape: {input_shape}")
+    print(f"Model Input Dtype: {input_dtype}")
+
+    # --- Load Labels ---
+    try:
+        with open(labels_path, 'r') as f:
+            labels = [line.strip() for line in f.readlines()]
+        print(f"Loaded Labels: {labels}")
+    except FileNotFoundError:
+        print(f"Error: labels.txt not found at {labels_path}. Please provide the correct path.")
+        raise
+    except Exception as e:
+        print(f"Error loading labels: {e}")
+        raise
+
+    # Ensure the input shape matches expectations
+    # Note: Teachable Machine audio models often expect a specific number of samples,
+    # which might not directly be CHUNK_SIZE if they do internal spectrogram conversion.
+    # For raw audio input like this script, CHUNK_SIZE should match model's expected raw audio length.
+    if len(input_shape) > 1 and input_shape[1] != CHUNK_SIZE:
+        print(f"Warning: Model expects input length {input_shape[1]}, but CHUNK_SIZE is {CHUNK_SIZE}.")
+        print("This might indicate an issue with your model or expected input preprocessing.")
+        print("Ensure your Teachable Machine model was trained with 1-second raw audio samples if CHUNK_SIZE reflects that.")
+        # Consider adjusting CHUNK_SIZE or your model's input layer.
 
 # --- Audio Recording Thread Function ---
 def audio_recorder():
     """Captures audio and puts it into the queue."""
     print("Audio recording thread started.")
     try:
+        import sounddevice as sd # Only needed for live input; keeps tm_model importable on headless boxes
+
         def callback(indata, frames, time_info, status):
             if status:
+                input_status_counter.inc()
                 print(status, flush=True)
             if not stop_event.is_set():
                 audio_queue.put(indata.copy()) # Put a copy into the queue
@@ -85,8 +112,8 @@ def audio_recorder():
         print("Audio recording thread stopped.")
 
 # --- Inference Function ---
-def process_audio_chunk(audio_data_raw):
-    """Processes a single audio chunk for inference."""
+def detect_wakeword(audio_data_raw):
+    """Runs inference on a single audio chunk. Returns the confidence if it is the wakeword, else None."""
     audio_data = audio_data_raw[:, 0] # Assuming mono, take the first channel
 
     # Normalize (optional, but often good practice if model was trained with normalized audio)
@@ -123,45 +150,65 @@ def process_audio_chunk(audio_data_raw):
             print(f"Reshaped input tensor to: {input_tensor.shape}")
         else:
             print("Cannot automatically reshape. Please check model input requirements.")
-            return # Skip inference if shape is wrong
+            return None # Skip inference if shape is wrong
 
-    try:
-        interpreter.set_tensor(input_details[0]['index'], input_tensor)
+    interpreter.set_tensor(input_details[0]['index'], input_tensor)
+    with invoke_timer.time():
         interpreter.invoke()
-        output_tensor = interpreter.get_tensor(output_details[0]['index'])
-        probabilities = np.array(output_tensor[0])
-
-        predicted_index = np.argmax(probabilities)
-        predicted_class = labels[predicted_index]
-        confidence = probabilities[predicted_index]
-
-        if confidence >= CONFIDENCE_THRESHOLD:
-            # print(f"Detected: {predicted_class} (Confidence: {confidence:.2f})")
-            if predicted_class == '1 ketta': # Make sure '1 ketta' is exactly what's in your labels.txt
-                print(f"WAKEWORD DETECTED! ({predicted_class} - Confidence: {confidence:.2f})")
-                control.send_ui_command('show')
-                vad.main() # Call your VAD function
-                # Be cautious: if vad.main() is blocking or long-running,
-                # it might still make the main loop less responsive.
-                # Consider if vad.main() also needs to be non-blocking or run in a thread.
+    output_tensor = interpreter.get_tensor(output_details[0]['index'])
+    probabilities = np.array(output_tensor[0])
+
+    predicted_index = np.argmax(probabilities)
+    predicted_class = labels[predicted_index]
+    confidence = probabilities[predicted_index]
+
+    if confidence >= CONFIDENCE_THRESHOLD:
+        # print(f"Detected: {predicted_class} (Confidence: {confidence:.2f})")
+        if predicted_class == '1 ketta': # Make sure '1 ketta' is exactly what's in your labels.txt
+            print(f"WAKEWORD DETECTED! ({predicted_class} - Confidence: {confidence:.2f})")
+            detection_counter.inc()
+            return float(confidence)
+    return None
+
+def start_turn(started_at, confidence):
+    """Begins a new turn after a detection: traces it and shows the orb. Returns its ID."""
+    turn = tracing.new_turn()
+    tracing.mark(turn, 'wakeword', 'start', t=started_at)
+    tracing.mark(turn, 'wakeword', 'end', confidence=confidence)
+    control.send_ui_command('show', turn=turn)
+    return turn
+
+def process_audio_chunk(audio_data_raw):
+    """Processes a single audio chunk for inference."""
+    started_at = time.monotonic()
+    try:
+        confidence = detect_wakeword(audio_data_raw)
+        if confidence is not None:
+            turn = start_turn(started_at, confidence)
+            vad.main(turn=turn) # Call your VAD function
+            # Be cautious: if vad.main() is blocking or long-running,
+            # it might still make the main loop less responsive.
+            # Consider if vad.main() also needs to be non-blocking or run in a thread.
     except Exception as e:
         print(f"Error during inference: {e}")
 
 
 # --- Main Loop ---
-if __name__ == "__main__":
+def main():
+    """Listens for the wakeword until stop_event is set. The model must already be loaded."""
+    bus.ensure_broker()
+    metrics.start()
     print("Starting wakeword recognition. Say 'ketta'...")
     print(f"Audio chunks will be {DURATION} second(s) long ({CHUNK_SIZE} samples at {SAMPLE_RATE} Hz).")
     print(f"Model expects input of type {input_dtype} and shape {input_shape}.")
 
-
     # Start the audio recording thread
     recording_thread = threading.Thread(target=audio_recorder, daemon=True) # daemon=True allows main to exit
     recording_thread.start()
 
     print("\nListening for wakeword... Press Ctrl+C to stop.")
     try:
-        while True:
+        while not stop_event.is_set():
             try:
                 # Get audio data from the queue, with a timeout to allow Ctrl+C
                 audio_chunk = audio_queue.get(timeout=0.1) # Timeout in seconds
@@ -169,19 +216,27 @@ if __name__ == "__main__":
                 audio_queue.task_done() # Signal that the item has been processed
             except queue.Empty:
                 # No audio data in the queue, continue looping
-                time.sleep(0.01) # Small sleep to prevent busy-waiting
                 continue
             except Exception as e:
                 print(f"Error in main loop: {e}")
                 break # Or handle more gracefully
-
-    except KeyboardInterrupt:
-        print("\nStopping recognition...")
     finally:
         print("Signalling recording thread to stop...")
         stop_event.set()
         if recording_thread.is_alive():
             recording_thread.join(timeout=2) # Wait for the thread to finish
         print("All threads stopped.")
-        # Clean up Sounddevice stream explicitly if needed, though context manager should handle it.
-        # sd.stop() # May not be necessary if InputStream context manager cleans up properly.
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Listen for the wakeword.")
+    parser.add_argument('--model', default=MODEL_PATH, help="TFLite wakeword model")
+    parser.add_argument('--labels', default=LABELS_PATH, help="labels for the model")
+    args = parser.parse_args()
+    try:
+        load_model(args.model, args.labels)
+    except Exception:
+        exit()
+    try:
+        main()
+    except KeyboardInterrupt:
+        print("\nStopping recognition...")
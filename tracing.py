@@ -0,0 +1,206 @@
+# tracing.py
+
+import os
+import sys
+import json
+import time
+import uuid
+import argparse
+import threading
+import collections
+import metrics
+
+# --- Configuration ---
+TRACE_FILE = 'ketta_trace.jsonl'
+# Histogram bucket upper bounds, in milliseconds.
+HISTOGRAM_BUCKETS_MS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, float('inf'))
+
+# Every mark is (stage, event). An interval is measured from one mark to another
+# within the same turn; together they cover the whole turn, stage by stage.
+INTERVALS = collections.OrderedDict([
+    ('wakeword inference', (('wakeword', 'start'), ('wakeword', 'end'))),
+    ('wake to listening', (('wakeword', 'end'), ('capture', 'start'))),
+    ('capture', (('capture', 'start'), ('capture', 'end'))),
+    ('endpointing', (('capture', 'speech_end'), ('capture', 'end'))),
+    ('stt', (('stt', 'start'), ('stt', 'end'))),
+    ('stt to llm', (('stt', 'end'), ('llm', 'start'))),
+    ('llm first token', (('llm', 'start'), ('llm', 'first_token'))),
+    ('llm total', (('llm', 'start'), ('llm', 'end'))),
+    ('app launch', (('action', 'start'), ('action', 'end'))),
+    ('llm to tts', (('llm', 'end'), ('tts', 'start'))),
+    ('tts first byte', (('tts', 'start'), ('tts', 'first_byte'))),
+    ('tts first audio', (('tts', 'start'), ('tts', 'first_audio'))),
+    ('playback', (('tts', 'first_audio'), ('tts', 'end'))),
+    ('speech end to first audio', (('capture', 'speech_end'), ('tts', 'first_audio'))),
+    ('wake to first audio', (('wakeword', 'end'), ('tts', 'first_audio'))),
+    ('turn total', (('wakeword', 'end'), ('tts', 'end'))),
+])
+
+_lock = threading.Lock()
+_trace_file = None
+
+def new_turn():
+    """Returns a fresh turn ID. Generated once per wakeword and carried through every hop."""
+    return uuid.uuid4().hex[:12]
+
+def mark(turn, stage, event, t=None, **details):
+    """
+    Records that `stage` reached `event` in `turn`, at monotonic time `t`
+    (now, by default). CLOCK_MONOTONIC is shared by all processes on the
+    machine, so marks written by different components line up. Marks without
+    a turn are ignored, which keeps callers free of `if turn` checks.
+    """
+    global _trace_file
+    if not turn:
+        return
+    record = {'turn': turn, 'stage': stage, 'event': event,
+              't': time.monotonic() if t is None else t, 'wall': time.time(), 'pid': os.getpid()}
+    if details:
+        record.update(details)
+    line = json.dumps(record, separators=(',', ':')) + '\n'
+    with _lock:
+        try:
+            if _trace_file is None:
+                _trace_file = open(TRACE_FILE, 'a', encoding='utf-8', buffering=1)
+            _trace_file.write(line) # Line-buffered O_APPEND: one write per mark, safe across processes
+        except OSError as e:
+            print(f"Could not write trace mark: {e}")
+
+# --- Carrying turns through files ---
+# Replies reach tts_online.py through output.txt rather than the bus, so the turn
+# rides along as a header line on the reply itself.
+TURN_HEADER = '#turn '
+
+def attach_turn(text, turn):
+    """Prefixes text with a turn header line. Empty text stays empty, so it is still read as "no reply"."""
+    return f"{TURN_HEADER}{turn}\n{text}" if turn and text else text
+
+def detach_turn(content):
+    """Splits content written by attach_turn() into (text, turn); turn is None if there was no header."""
+    if content.startswith(TURN_HEADER):
+        header, _, text = content.partition('\n')
+        return text, header[len(TURN_HEADER):].strip() or None
+    return content, None
+
+# --- Reading traces ---
+def load_turns(path=TRACE_FILE, since=None):
+    """Returns {turn: [mark, ...]} in file order, optionally only for marks newer than `since` (epoch s)."""
+    turns = collections.OrderedDict()
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue # A line cut short by a crash
+                if since is not None and record.get('wall', 0) < since:
+                    continue
+                turns.setdefault(record['turn'], []).append(record)
+    except FileNotFoundError:
+        pass
+    return turns
+
+def turn_intervals(marks):
+    """Returns {interval name: milliseconds} for every interval both of whose marks are present."""
+    first = {}
+    for record in marks:
+        first.setdefault((record['stage'], record['event']), record['t'])
+    intervals = {}
+    for name, (start, end) in INTERVALS.items():
+        if start in first and end in first:
+            intervals[name] = (first[end] - first[start]) * 1000
+    return intervals
+
+def histogram(values_ms):
+    counts = [0] * len(HISTOGRAM_BUCKETS_MS)
+    for value in values_ms:
+        for i, bound in enumerate(HISTOGRAM_BUCKETS_MS):
+            if value <= bound:
+                counts[i] += 1
+                break
+    return counts
+
+def aggregate(turns):
+    """Returns {interval name: sorted list of milliseconds} across all turns."""
+    samples = collections.OrderedDict((name, []) for name in INTERVALS)
+    for marks in turns.values():
+        for name, value in turn_intervals(marks).items():
+            samples[name].append(value)
+    return collections.OrderedDict((name, sorted(values)) for name, values in samples.items() if values)
+
+# --- CLI ---
+def print_summary(turns, show_histograms):
+    samples = aggregate(turns)
+    print(f"{len(turns)} turns")
+    if not samples:
+        return
+    print(f"{'interval':<28}{'n':>5}{'p50':>9}{'p90':>9}{'p99':>9}{'max':>9}  (ms)")
+    for name, values in samples.items():
+        summary = metrics.summarize(values)
+        print(f"{name:<28}{summary['count']:>5}{summary['p50']:>9.0f}{summary['p90']:>9.0f}"
+              f"{summary['p99']:>9.0f}{summary['max']:>9.0f}")
+    if not show_histograms:
+        return
+    for name, values in samples.items():
+        print(f"\n{name}")
+        counts = histogram(values)
+        widest = max(counts)
+        for bound, count in zip(HISTOGRAM_BUCKETS_MS, counts):
+            label = f"<= {bound:.0f} ms" if bound != float('inf') else f"> {HISTOGRAM_BUCKETS_MS[-2]:.0f} ms"
+            print(f"  {label:>12} {count:>5} {'#' * round(40 * count / widest)}")
+
+def print_turns(turns):
+    columns = ('stt', 'llm total', 'tts first audio', 'wake to first audio', 'turn total')
+    print(f"{'turn':<14}" + ''.join(f"{name:>22}" for name in columns) + "  (ms)")
+    for turn, marks in turns.items():
+        intervals = turn_intervals(marks)
+        print(f"{turn:<14}" + ''.join(f"{intervals[name]:>22.0f}" if name in intervals else f"{'-':>22}"
+                                      for name in columns))
+
+def print_turn(turn, marks):
+    marks = sorted(marks, key=lambda record: record['t'])
+    start = marks[0]['t']
+    print(f"Turn {turn}")
+    for record in marks:
+        print(f"  {(record['t'] - start) * 1000:>9.1f} ms  {record['stage']}:{record['event']}  (pid {record['pid']})")
+    for name, value in turn_intervals(marks).items():
+        print(f"  {name:<28}{value:>9.1f} ms")
+
+def main(argv=None):
+    # The filters are accepted before or after the subcommand ("tracing.py turns --last 20").
+    # SUPPRESS keeps a subcommand's unset default from overwriting a value given before it;
+    # the real defaults are applied after parsing.
+    filters = argparse.ArgumentParser(add_help=False)
+    filters.add_argument('--file', default=argparse.SUPPRESS, help="trace file to read")
+    filters.add_argument('--since', type=float, default=argparse.SUPPRESS, help="only marks from the last N seconds")
+    filters.add_argument('--last', type=int, default=argparse.SUPPRESS, help="only the last N turns")
+    parser = argparse.ArgumentParser(description="Query Ketta's per-turn latency traces.", parents=[filters])
+    subparsers = parser.add_subparsers(dest='command')
+    summary_parser = subparsers.add_parser('summary', parents=[filters], help="per-stage latency percentiles")
+    summary_parser.add_argument('--histograms', action='store_true', help="also print histograms")
+    subparsers.add_parser('turns', parents=[filters], help="one line per turn")
+    turn_parser = subparsers.add_parser('turn', parents=[filters], help="timeline of a single turn")
+    turn_parser.add_argument('turn_id')
+    args = parser.parse_args(argv)
+    for name, default in (('file', TRACE_FILE), ('since', None), ('last', None)):
+        if not hasattr(args, name):
+            setattr(args, name, default)
+
+    since = time.time() - args.since if args.since else None
+    turns = load_turns(args.file, since)
+    if args.last:
+        turns = collections.OrderedDict(list(turns.items())[-args.last:])
+
+    if args.command == 'turns':
+        print_turns(turns)
+    elif args.command == 'turn':
+        if args.turn_id not in turns:
+            print(f"Turn '{args.turn_id}' not found in {args.file}.")
+            return 1
+        print_turn(args.turn_id, turns[args.turn_id])
+    else:
+        print_summary(turns, getattr(args, 'histograms', False))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
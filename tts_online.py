@@ -4,117 +4,301 @@ import subprocess
 import os
 import threading
 import time
+import queue
+import json
 import socket
+import http.client
+import urllib.parse
+import bus
+import tracing
 import control
-import requests
+import metrics
 import stream2sentence as s2s
 
 # --- Configuration ---
 AUDIO_API_URL = "https://kettatts.vercel.app/api/generate-audio-stream"
-TTS_COMMAND_UDP_PORT = 45456
 INPUT_FILE_NAME = 'output.txt'
+CLAIMED_FILE_NAME = 'output.txt.playing' # The reply currently being spoken
+POLL_INTERVAL = 0.02 # Seconds between checks for new replies / cancellation
+REQUEST_TIMEOUT = 90 # Seconds to connect, and then between bytes of the audio stream
+PLAYER_COMMAND = ['ffplay', '-nodisp', '-autoexit', '-loglevel', 'error', '-i', '-'] # Reads audio on stdin
 
 # --- Global State ---
-current_playback_process = None
-main_process_stop_event = threading.Event()
+state_lock = threading.Lock()
+current_run = None # The PlaybackRun currently speaking, if any
+pending_hide_timer = None
+shutdown_event = threading.Event()
 
-def stream_audio_from_api(text_chunk):
-    """Calls the streaming audio API and yields audio chunks."""
-    payload = {"text": text_chunk}
+class PlaybackRun:
+    """State for speaking one reply, so a cancellation only ever hits the reply it was meant for."""
+    def __init__(self, turn=None):
+        self.turn = turn
+        self.cancel_event = threading.Event()
+        self.playback_process = None
+        self.connection = None # HTTP connection to the audio API, reused for every sentence of the reply
+        self.audio_queue = None
+        self.stop_requested_at = None
+
+    def cancel(self):
+        """Stops playback, discards buffered audio and aborts the in-flight synthesis request."""
+        self.stop_requested_at = time.perf_counter()
+        self.cancel_event.set()
+        with state_lock:
+            process, connection = self.playback_process, self.connection
+        # SIGKILL rather than SIGTERM: ffplay must not drain what it has already buffered.
+        if process and process.poll() is None:
+            process.kill()
+        if connection is not None:
+            abort_connection(connection)
+
+# --- Metrics ---
+def _player_running():
+    run = current_run
+    process = run.playback_process if run is not None else None
+    return int(process is not None and process.poll() is None)
+
+def _audio_backlog():
+    run = current_run
+    return run.audio_queue.qsize() if run is not None and run.audio_queue is not None else 0
+
+metrics.gauge('ketta_tts_player_running', "1 while the audio player process is alive", fn=_player_running)
+metrics.gauge('ketta_tts_audio_backlog', "Audio chunks fetched but not yet written to the player", fn=_audio_backlog)
+reply_counter = metrics.counter('ketta_tts_replies_total', "Replies spoken or started")
+cancel_counter = metrics.counter('ketta_tts_cancelled_total', "Replies cut off by 'stop_audio'")
+player_failure_counter = metrics.counter('ketta_tts_player_failures_total', "Player processes that exited mid-reply")
+cancel_timer = metrics.timer('ketta_tts_cancel_seconds', "Time from 'stop_audio' to playback fully stopped")
+
+def abort_connection(connection):
+    """
+    Shuts down the socket under an HTTP connection, so a thread blocked sending the
+    request, waiting for the headers or reading the body returns immediately.
+    """
+    sock = connection.sock
+    try:
+        if sock is not None:
+            sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+def open_connection(run):
+    """Returns the run's connection to the audio API, opening one if it has none."""
+    with state_lock:
+        if run.connection is None:
+            url = urllib.parse.urlsplit(AUDIO_API_URL)
+            connection_class = http.client.HTTPSConnection if url.scheme == 'https' else http.client.HTTPConnection
+            # Kept on the run before it connects, so cancel() can reach the socket from the moment it exists.
+            run.connection = connection_class(url.netloc, timeout=REQUEST_TIMEOUT)
+        return run.connection
+
+def close_connection(run):
+    with state_lock:
+        connection, run.connection = run.connection, None
+    if connection is not None:
+        connection.close()
+
+def stream_audio_from_api(text_chunk, run):
+    """Calls the streaming audio API and yields audio chunks until the run is cancelled."""
+    url = urllib.parse.urlsplit(AUDIO_API_URL)
+    body = json.dumps({"text": text_chunk}).encode('utf-8')
+    finished = False
+    try:
+        connection = open_connection(run)
+        path = f"{url.path or '/'}?{url.query}" if url.query else url.path or '/'
+        connection.request('POST', path, body=body, headers={'Content-Type': 'application/json'})
+        # A cancel that came while connecting found no socket to shut down.
+        if run.cancel_event.is_set():
+            return
+        response = connection.getresponse()
+        if response.status == 200:
+            print(f"Streaming audio for: '{text_chunk}'")
+            while not run.cancel_event.is_set():
+                chunk = response.read1(4096)
+                if not chunk:
+                    response.read() # Consumes the end of the body and releases the connection
+                    finished = True
+                    break
+                yield chunk
+        else:
+            error = response.read().decode('utf-8', errors='replace')
+            finished = True
+            print(f"API Error for '{text_chunk}': Status {response.status}, {error}")
+    except (OSError, http.client.HTTPException) as e:
+        # An aborted request surfaces as a connection/protocol error; only report real failures.
+        if not run.cancel_event.is_set():
+            print(f"API Connection Error: {e}")
+    finally:
+        # Only a fully read response leaves the connection reusable for the next sentence.
+        if not finished or response.will_close:
+            close_connection(run)
+
+def audio_fetch_worker(text, run, audio_queue):
+    """Synthesizes every sentence of the reply in order and queues the audio for playback."""
+    first_chunk = True
     try:
-        with requests.post(AUDIO_API_URL, json=payload, stream=True, timeout=90) as response:
-            if response.status_code == 200:
-                print(f"Streaming audio for: '{text_chunk}'")
-                for chunk in response.iter_content(chunk_size=4096):
-                    yield chunk
-            else:
-                print(f"API Error for '{text_chunk}': Status {response.status_code}, {response.text}")
-    except requests.exceptions.RequestException as e:
-        print(f"API Connection Error: {e}")
-
-def command_listener_thread():
-    """Listens for 'stop_audio' commands."""
-    global current_playback_process
-    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
-        sock.bind(('localhost', TTS_COMMAND_UDP_PORT))
-        print(f"TTS script listening for commands on UDP port {TTS_COMMAND_UDP_PORT}")
-        while True:
-            data, _ = sock.recvfrom(1024)
-            command = data.decode('utf-8').strip()
-            if command == 'stop_audio':
-                print("Received 'stop_audio' command. Halting playback.")
-                main_process_stop_event.set()
-                if current_playback_process and current_playback_process.poll() is None:
-                    current_playback_process.terminate()
-                control.send_ui_command('reset')
+        for sentence in s2s.generate_sentences(text, minimum_sentence_length=8):
+            if run.cancel_event.is_set():
+                break
+            for audio_chunk in stream_audio_from_api(sentence, run):
+                if first_chunk:
+                    tracing.mark(run.turn, 'tts', 'first_byte')
+                    first_chunk = False
+                audio_queue.put(audio_chunk)
+    except Exception as e:
+        print(f"An error occurred while fetching audio: {e}")
+    finally:
+        close_connection(run)
+        audio_queue.put(None) # End-of-reply marker
+
+def handle_command(command, message):
+    """Handles 'stop_audio' commands from the message bus."""
+    if command == 'stop_audio':
+        with state_lock:
+            run = current_run
+        if run is None:
+            print("Received 'stop_audio' command, but nothing is playing.")
+        else:
+            print("Received 'stop_audio' command. Halting playback.")
+            run.cancel()
+        control.send_ui_command('reset')
+
+def wait_for_reply():
+    """Blocks until a reply is waiting and claims it. Returns (text, turn), or None on shutdown."""
+    while not shutdown_event.is_set():
+        if os.path.exists(INPUT_FILE_NAME) and os.path.getsize(INPUT_FILE_NAME) > 0:
+            try:
+                # Renaming claims the reply atomically, so a new one written while we
+                # speak lands in a fresh INPUT_FILE_NAME instead of being deleted with this one.
+                os.replace(INPUT_FILE_NAME, CLAIMED_FILE_NAME)
+                with open(CLAIMED_FILE_NAME, 'r', encoding='utf-8') as f:
+                    return tracing.detach_turn(f.read())
+            except FileNotFoundError:
+                continue
+        time.sleep(POLL_INTERVAL)
+    return None
+
+def play_reply(text, run):
+    """Pipes the synthesized audio of one reply into a single ffplay process."""
+    process = subprocess.Popen(PLAYER_COMMAND, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL)
+    with state_lock:
+        run.playback_process = process
+
+    audio_queue = queue.Queue()
+    run.audio_queue = audio_queue
+    fetch_thread = threading.Thread(target=audio_fetch_worker, args=(text, run, audio_queue), daemon=True)
+    fetch_thread.start()
+
+    first_write = True
+    try:
+        # The network is read on the fetch thread, so this loop notices a cancellation
+        # within POLL_INTERVAL no matter how long the API takes to answer.
+        while not run.cancel_event.is_set():
+            try:
+                audio_chunk = audio_queue.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                continue
+            if audio_chunk is None:
+                break
+            try:
+                if first_write:
+                    tracing.mark(run.turn, 'tts', 'first_audio')
+                    first_write = False
+                process.stdin.write(audio_chunk)
+            except (BrokenPipeError, OSError, ValueError):
+                if not run.cancel_event.is_set():
+                    print("ffplay process closed prematurely.")
+                    player_failure_counter.inc()
+                    run.cancel_event.set()
+                break
+
+        if not run.cancel_event.is_set():
+            # Close the pipe and let ffplay finish naturally; a cancel kills it and ends the wait.
+            process.stdin.close()
+            process.wait()
+    finally:
+        if process.poll() is None:
+            process.kill()
+        try:
+            process.stdin.close()
+        except (BrokenPipeError, OSError):
+            pass
+        process.wait()
+
+def speak_reply(text, turn=None):
+    """Speaks one reply from start to finish, tracing it under `turn`. Returns its PlaybackRun."""
+    global current_run, pending_hide_timer
+    # A reply arriving right after the previous one must not be hidden by its delayed 'hide'.
+    if pending_hide_timer is not None:
+        pending_hide_timer.cancel()
+        pending_hide_timer = None
+
+    run = PlaybackRun(turn)
+    reply_counter.inc()
+    tracing.mark(run.turn, 'tts', 'start')
+    with state_lock:
+        current_run = run
+    try:
+        print("--- File detected. Starting continuous audio pipeline. ---")
+        control.send_ui_command('speaking', turn=run.turn)
+        play_reply(text, run)
+
+        if not run.cancel_event.is_set():
+            print("\n--- Playback finished successfully. ---")
+            control.send_ui_command('reset', turn=run.turn)
+            # Hide after a moment without blocking, so the next reply can start straight away.
+            pending_hide_timer = threading.Timer(1.0, control.send_ui_command, args=('hide',))
+            pending_hide_timer.daemon = True
+            pending_hide_timer.start()
+        else:
+            print("\n--- Playback was interrupted. ---")
+
+    except Exception as e:
+        print(f"An error occurred in the main loop: {e}")
+
+    finally:
+        with state_lock:
+            current_run = None
+        if run.stop_requested_at is not None:
+            latency_ms = (time.perf_counter() - run.stop_requested_at) * 1000
+            cancel_counter.inc()
+            cancel_timer.observe(latency_ms / 1000)
+            print(f"Cancellation completed in {latency_ms:.1f} ms.")
+            tracing.mark(run.turn, 'tts', 'end', cancelled=True, cancel_latency_ms=latency_ms)
+        else:
+            tracing.mark(run.turn, 'tts', 'end')
+    return run
 
 def main_process():
-    """Waits for the input file, processes it, and streams audio continuously."""
-    global current_playback_process
-    while not main_process_stop_event.is_set():
+    """Waits for replies and streams their audio, one reply at a time."""
+    while not shutdown_event.is_set():
+        print(f"\n--- Waiting for '{INPUT_FILE_NAME}' to appear and have content... ---")
+        reply = wait_for_reply()
+        if reply is None:
+            return
         try:
-            print(f"\n--- Waiting for '{INPUT_FILE_NAME}' to appear and have content... ---")
-            
-            while not (os.path.exists(INPUT_FILE_NAME) and os.path.getsize(INPUT_FILE_NAME) > 0):
-                if main_process_stop_event.is_set(): return
-                time.sleep(0.1)
-            
-            print("--- File detected. Starting continuous audio pipeline. ---")
-            control.send_ui_command('speaking')
-
-            with open(INPUT_FILE_NAME, 'r', encoding='utf-8') as f:
-                sentence_generator = s2s.generate_sentences(f, minimum_sentence_length=8)
-
-                # --- THIS IS THE KEY ARCHITECTURAL CHANGE ---
-                # 1. Launch ffplay ONCE outside the loop.
-                ffplay_cmd = ['ffplay', '-nodisp', '-autoexit', '-loglevel', 'error', '-i', '-']
-                current_playback_process = subprocess.Popen(ffplay_cmd, stdin=subprocess.PIPE)
-                
-                # 2. Iterate through sentences and pipe all audio to the SINGLE ffplay process.
-                for sentence in sentence_generator:
-                    if main_process_stop_event.is_set(): break
-                    
-                    audio_chunk_generator = stream_audio_from_api(sentence)
-                    
-                    for audio_chunk in audio_chunk_generator:
-                        try:
-                            if current_playback_process.stdin:
-                                current_playback_process.stdin.write(audio_chunk)
-                            else:
-                                break
-                        except (BrokenPipeError, OSError):
-                            print("ffplay process closed prematurely.")
-                            main_process_stop_event.set() # Set stop event to exit cleanly
-                            break
-                
-                # 3. After the loop, close the pipe and wait for ffplay to finish naturally.
-                if current_playback_process.stdin:
-                    current_playback_process.stdin.close()
-                current_playback_process.wait()
-                # --- END OF CHANGE ---
-
-            if not main_process_stop_event.is_set():
-                print("\n--- Playback finished successfully. ---")
-                control.send_ui_command('reset')
-                time.sleep(1)
-                control.send_ui_command('hide')
-            else:
-                print("\n--- Playback was interrupted. ---")
-        
-        except Exception as e:
-            print(f"An error occurred in the main loop: {e}")
-        
+            speak_reply(*reply)
         finally:
-            if os.path.exists(INPUT_FILE_NAME):
-                os.remove(INPUT_FILE_NAME)
-            main_process_stop_event.clear()
-            current_playback_process = None
+            if os.path.exists(CLAIMED_FILE_NAME):
+                os.remove(CLAIMED_FILE_NAME)
+
+def main():
+    """Listens for commands on the message bus and speaks replies until shutdown_event is set."""
+    bus.ensure_broker()
+    metrics.start()
+    bus.subscribe(bus.TOPIC_TTS_COMMAND, handle_command)
+    print(f"TTS script listening for commands on '{bus.TOPIC_TTS_COMMAND}'")
+    main_process()
+
+def shutdown():
+    """Stops main() and cuts off whatever is being spoken."""
+    shutdown_event.set()
+    with state_lock:
+        run = current_run
+    if run is not None:
+        run.cancel()
 
 if __name__ == "__main__":
-    cmd_thread = threading.Thread(target=command_listener_thread, daemon=True)
-    cmd_thread.start()
     try:
-        main_process()
+        main()
     except KeyboardInterrupt:
         print("\nProgram interrupted by user. Shutting down...")
-        main_process_stop_event.set()
+        shutdown()
@@ -1,137 +1,210 @@
 import webrtcvad
 import collections
 import sys
-import pyaudio
-import wave
 import time
-import speech_recognition as sr
+import threading
 import numpy as np
-import socket
+import bus
+import tracing
+import metrics
 
 # Import the command sender to control the UI
 from control import send_ui_command
 
 # --- Configuration ---
-# UDP socket for sending LOUDNESS data to the UI
-LOUDNESS_HOST = "127.0.0.1"
-LOUDNESS_UDP_PORT = 45455
 SENSITIVITY = 500.0
 
-# UDP socket for sending TRANSCRIBED TEXT to the main_loop script
-TEXT_HOST = "127.0.0.1"
-TEXT_UDP_PORT = 45457 # A new, dedicated port for text
-
-def main():
-    """Listens for speech, transcribes, and sends text to the logic loop."""
-    # Audio format settings
-    FORMAT = pyaudio.paInt16
-    CHANNELS = 1
-    RATE = 16000
-    CHUNK_DURATION_MS = 30
-    PADDING_DURATION_MS = 1000 # 1 second of pre-speech audio buffer
-    CHUNK_SIZE = int(RATE * CHUNK_DURATION_MS / 1000)
-    NUM_PADDING_CHUNKS = int(PADDING_DURATION_MS / CHUNK_DURATION_MS)
-    
+# Audio format settings (16-bit signed mono)
+SAMPLE_WIDTH = 2 # Bytes per sample
+CHANNELS = 1
+RATE = 16000
+CHUNK_DURATION_MS = 30
+PADDING_DURATION_MS = 1000 # 1 second of pre-speech audio buffer
+END_OF_SPEECH_MS = 1200 # This much silence after speech ends the recording
+SPECULATION_SILENCE_MS = 400 # After this much silence, transcribe early so the logic loop can get a head start (None to disable)
+CHUNK_SIZE = int(RATE * CHUNK_DURATION_MS / 1000)
+NUM_PADDING_CHUNKS = int(PADDING_DURATION_MS / CHUNK_DURATION_MS)
+
+stt_timer = metrics.timer('ketta_stt_seconds', "Duration of each transcription")
+
+def send_text(text, turn=None):
+    """Hands a transcript (or an error code) to the logic loop, reporting if nobody received it."""
+    if not bus.publish(bus.TOPIC_STT_TEXT, text, ack=True, turn=turn):
+        print(f"Transcript '{text}' was not delivered to the logic loop.")
+
+def compute_loudness(chunk):
+    np_data = np.frombuffer(chunk, dtype=np.int16)
+    rms = np.sqrt(np.mean(np_data.astype(np.float32)**2))
+    return min(1.0, (rms / SENSITIVITY))
+
+def capture_utterance(read_chunk, turn=None, on_pause=None):
+    """
+    Reads CHUNK_SIZE-frame chunks from read_chunk() until an utterance has been
+    spoken and followed by END_OF_SPEECH_MS of silence, and returns its audio
+    (with up to PADDING_DURATION_MS of lead-in). Silence is counted in audio
+    time, so recorded audio can be fed faster than real time. If read_chunk()
+    returns an empty chunk (end of a recording), whatever was captured is returned.
+    on_pause(audio) is called with the audio so far once SPECULATION_SILENCE_MS
+    of silence has passed, and on_pause(None) if speech then resumes.
+    """
     vad = webrtcvad.Vad(3) # VAD aggressiveness (0-3)
-    pa_instance = pyaudio.PyAudio()
-    
-    # Sockets for communication
-    loudness_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    text_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-
-    # This outer loop allows the script to listen for a new conversation after one ends.
-    while True: 
-        stream = pa_instance.open(format=FORMAT, channels=CHANNELS, rate=RATE,
+    ring_buffer = collections.deque(maxlen=NUM_PADDING_CHUNKS)
+    triggered = False
+    voiced_frames = []
+
+    tracing.mark(turn, 'capture', 'start')
+    print("\nListening for speech...")
+
+    # --- Listen for the first word ---
+    while not triggered:
+        chunk = read_chunk()
+        if not chunk:
+            return b''
+
+        # Calculate and send loudness to the UI
+        try:
+            bus.publish(bus.TOPIC_UI_LOUDNESS, float(compute_loudness(chunk)))
+        except Exception as e:
+            print(f"Loudness calc/send error: {e}")
+
+        is_speech = vad.is_speech(chunk, RATE)
+        if is_speech:
+            sys.stdout.write('+')
+            tracing.mark(turn, 'capture', 'speech_start')
+            triggered = True
+            voiced_frames.extend(list(ring_buffer))
+            voiced_frames.append(chunk)
+        else:
+            sys.stdout.write('-')
+            ring_buffer.append(chunk)
+        sys.stdout.flush()
+
+    # --- Voice detected, start recording until silence ---
+    print("\nSpeech detected, recording...")
+    silence_start_time = None
+    silent_chunks = 0
+    while triggered:
+        chunk = read_chunk()
+        if not chunk:
+            break
+        voiced_frames.append(chunk)
+
+        # Keep sending loudness
+        bus.publish(bus.TOPIC_UI_LOUDNESS, float(compute_loudness(chunk)))
+
+        is_speech = vad.is_speech(chunk, RATE)
+        if not is_speech:
+            if silence_start_time is None:
+                silence_start_time = time.monotonic()
+            silent_chunks += 1
+            if silent_chunks * CHUNK_DURATION_MS > END_OF_SPEECH_MS: # 1.2s of silence ends recording
+                triggered = False
+            elif (on_pause is not None and SPECULATION_SILENCE_MS is not None
+                  and silent_chunks == SPECULATION_SILENCE_MS // CHUNK_DURATION_MS):
+                on_pause(b''.join(voiced_frames))
+        else:
+            if on_pause is not None and SPECULATION_SILENCE_MS is not None \
+                    and silent_chunks >= SPECULATION_SILENCE_MS // CHUNK_DURATION_MS:
+                on_pause(None) # Just a pause; the early transcript is out of date
+            silence_start_time = None
+            silent_chunks = 0
+
+    print("Recording finished.")
+    tracing.mark(turn, 'capture', 'speech_end', t=silence_start_time)
+    tracing.mark(turn, 'capture', 'end')
+    return b''.join(voiced_frames)
+
+def transcribe(wav_data):
+    """Transcribes 16-bit mono RATE audio with Google's free web API. Returns the text or an error code."""
+    import speech_recognition as sr
+    try:
+        recognizer = sr.Recognizer()
+        audio_data = sr.AudioData(wav_data, RATE, SAMPLE_WIDTH)
+        text = recognizer.recognize_google(audio_data, language="en-US")
+        print("Recognized Text:", text)
+        return text
+    except sr.UnknownValueError:
+        print("Speech was not understood.")
+        # A specific error message so the main loop can handle it
+        return '__speech_not_understood__'
+    except sr.RequestError as e:
+        print(f"Google Speech Recognition request failed: {e}")
+        return '__recognition_error__'
+
+def main(turn=None, read_chunk=None, transcriber=transcribe):
+    """
+    Listens for speech, transcribes, and sends text to the logic loop, tracing
+    it under `turn`. Audio comes from the microphone unless read_chunk is given.
+    """
+    stream = None
+    if read_chunk is None:
+        import pyaudio # Only needed for live input; recorded audio can be fed through read_chunk
+        pa_instance = pyaudio.PyAudio()
+        stream = pa_instance.open(format=pyaudio.paInt16, channels=CHANNELS, rate=RATE,
                                   input=True, frames_per_buffer=CHUNK_SIZE)
-        
-        ring_buffer = collections.deque(maxlen=NUM_PADDING_CHUNKS)
-        triggered = False
-        voiced_frames = []
-        
-        send_ui_command("listening")
-        print("\nListening for speech...")
-        
-        # --- Listen for the first word ---
-        while not triggered:
-            chunk = stream.read(CHUNK_SIZE)
-            
-            # Calculate and send loudness to the UI
+        read_chunk = lambda: stream.read(CHUNK_SIZE)
+
+    # An early transcript, taken when the speaker pauses, is published so the logic loop can
+    # start its request; if they turn out to have finished, it also stands in for the final one.
+    early = {}
+    def on_pause(audio):
+        if audio is None:
+            early.clear()
+            return
+        attempt = {'done': threading.Event()}
+        early['attempt'] = attempt
+        def transcribe_early():
             try:
-                np_data = np.frombuffer(chunk, dtype=np.int16)
-                rms = np.sqrt(np.mean(np_data.astype(np.float32)**2))
-                loudness = min(1.0, (rms / SENSITIVITY))
-                loudness_sock.sendto(str(loudness).encode('utf-8'), (LOUDNESS_HOST, LOUDNESS_UDP_PORT))
+                attempt['text'] = transcriber(audio)
+                if early.get('attempt') is attempt and not attempt['text'].startswith('__'):
+                    bus.publish(bus.TOPIC_STT_PARTIAL, attempt['text'], turn=turn)
             except Exception as e:
-                print(f"Loudness calc/send error: {e}")
-
-            is_speech = vad.is_speech(chunk, RATE)
-            if is_speech:
-                sys.stdout.write('+')
-                triggered = True
-                voiced_frames.extend(list(ring_buffer))
-                voiced_frames.append(chunk)
-            else:
-                sys.stdout.write('-')
-                ring_buffer.append(chunk)
-            sys.stdout.flush()
-
-        # --- Voice detected, start recording until silence ---
-        print("\nSpeech detected, recording...")
-        silence_start_time = None
-        while triggered:
-            chunk = stream.read(CHUNK_SIZE)
-            voiced_frames.append(chunk)
+                print(f"Early transcription failed: {e}")
+            finally:
+                attempt['done'].set()
+        threading.Thread(target=transcribe_early, daemon=True).start()
 
-            # Keep sending loudness
-            np_data = np.frombuffer(chunk, dtype=np.int16)
-            rms = np.sqrt(np.mean(np_data.astype(np.float32)**2))
-            loudness = min(1.0, (rms / SENSITIVITY))
-            loudness_sock.sendto(str(loudness).encode('utf-8'), (LOUDNESS_HOST, LOUDNESS_UDP_PORT))
-
-            is_speech = vad.is_speech(chunk, RATE)
-            if not is_speech:
-                if silence_start_time is None:
-                    silence_start_time = time.time()
-                elif time.time() - silence_start_time > 1.2: # 1.2s of silence ends recording
-                    triggered = False
-            else:
-                silence_start_time = None
-        
-        print("Recording finished.")
-        stream.stop_stream()
-        stream.close()
-
-        # --- Process, Transcribe, and Send ---
-        send_ui_command("thinking")
-        loudness_sock.sendto(b'0.0', (LOUDNESS_HOST, LOUDNESS_UDP_PORT)) # Reset loudness meter
-        
-        wav_data = b''.join(voiced_frames)
-        
-        try:
-            recognizer = sr.Recognizer()
-            audio_data = sr.AudioData(wav_data, RATE, pa_instance.get_sample_size(FORMAT))
-            
-            # Use Google's free web API for speech recognition
-            text = recognizer.recognize_google(audio_data, language="en-US")
-            print("Recognized Text:", text)
-            
-            # SEND THE RECOGNIZED TEXT TO THE MAIN_LOOP SCRIPT
-            text_sock.sendto(text.encode('utf-8'), (TEXT_HOST, TEXT_UDP_PORT))
-            
-        except sr.UnknownValueError:
-            print("Speech was not understood.")
-            # Send a specific error message so the main loop can handle it
-            text_sock.sendto(b'__speech_not_understood__', (TEXT_HOST, TEXT_UDP_PORT))
-        except sr.RequestError as e:
-            print(f"Google Speech Recognition request failed: {e}")
-            text_sock.sendto(b'__recognition_error__', (TEXT_HOST, TEXT_UDP_PORT))
-        except Exception as e:
-            print(f"An unexpected error occurred: {e}")
-        break
+    send_ui_command("listening", turn=turn)
+    try:
+        wav_data = capture_utterance(read_chunk, turn, on_pause)
+    finally:
+        if stream is not None:
+            stream.stop_stream()
+            stream.close()
+
+    # --- Process, Transcribe, and Send ---
+    send_ui_command("thinking", turn=turn)
+    bus.publish(bus.TOPIC_UI_LOUDNESS, 0.0) # Reset loudness meter
+
+    try:
+        tracing.mark(turn, 'stt', 'start')
+        attempt = early.get('attempt')
+        text = None
+        if attempt is not None:
+            # Nothing but silence was recorded since the early transcript, so it is the final one.
+            attempt['done'].wait()
+            text = attempt.get('text')
+        if text is None or text.startswith('__'):
+            # An early attempt that failed, even transiently, gets a second chance on the full recording.
+            with stt_timer.time():
+                text = transcriber(wav_data)
+        error = {'__speech_not_understood__': 'not_understood', '__recognition_error__': 'request_failed'}.get(text)
+        if error:
+            tracing.mark(turn, 'stt', 'end', error=error)
+        else:
+            tracing.mark(turn, 'stt', 'end')
+
+        # SEND THE RECOGNIZED TEXT TO THE MAIN_LOOP SCRIPT
+        send_text(text, turn)
+        return text
+    except Exception as e:
+        print(f"An unexpected error occurred: {e}")
 
 if __name__ == "__main__":
     try:
-        main_speech_loop()
+        bus.ensure_broker()
+        metrics.start()
+        main()
     except KeyboardInterrupt:
         print("\nSpeech listener interrupted by user.")
         send_ui_command("reset")